@@ -1,6 +1,4 @@
-import os.path
 from datetime import datetime, timedelta
-from urlparse import urlparse, parse_qs
 import logging
 
 from flask import jsonify, request
@@ -28,14 +26,40 @@ from mediacore.utils.google import get_auth_url, set_credentials
 
 from media import settings, get_factory
 from media.apps import app
-
-
-EXTRA_FIELDS = ('date', 'rating', 'classification', 'genre', 'country',
-    'network', 'next_episode', 'director', 'stars', 'airs',
-    'runtime', 'title', 'url')
-SEARCH_FIELDS = ('name', 'files', 'extra.imdb.director', 'extra.imdb.stars',
-    'extra.imdb.genre', 'extra.tvrage.genre', 'extra.lastfm.genre',
-    'extra.sputnikmusic.genre', 'extra.tvrage.classification')
+from media.apps.cache import cached
+from media.model.version import Version
+from media.utils.search import (get_search_spec, update_search_tokens,
+        add_search_tokens)
+from media.utils.summary import SUMMARY_FIELDS, get_summary
+from media.utils.cursor import get_cursor, get_cursor_spec
+
+
+LIST_FIELDS = {
+    'media': ['name', 'info', 'date', 'created', 'source', 'src',
+        'rating', 'urls', 'subtitles', 'summary'],
+    'release': ['name', 'info', 'date', 'created', 'source', 'src',
+        'rating', 'release', 'artist', 'album', 'summary'],
+    }
+# The search and similar objects are listed without their extra,
+# the rendered part of it is in their summary
+LIST_FIELDS_EXCLUDED = ['extra', 'search_tokens']
+LIST_SORTS = {  # sorts ending with _id for the cursor pagination
+    'date': [('date', DESCENDING), ('created', DESCENDING), ('_id', DESCENDING)],
+    'name': [('name', ASCENDING), ('_id', ASCENDING)],
+    'rating': [('rating', DESCENDING), ('_id', DESCENDING)],
+    }
+LIST_SORT_DEF = 'date'
+RELEVANCE_SORT = [('score', {'$meta': 'textScore'}), ('_id', DESCENDING)]
+TEXT_INDEX = [('name', 'text'), ('search_tokens', 'text')]
+TEXT_WEIGHTS = {'name': 2}
+# The *_keys versions change with the searches existence and keys,
+# which set the has_search and has_similar flags of the items
+LIST_VERSIONS = {
+    'media': ('media', 'search_keys', 'similar_keys'),
+    'release': ('release', 'search_keys', 'similar_keys'),
+    'search': ('search', 'similar_keys'),
+    'similar': ('similar',),
+    }
 
 logger = logging.getLogger(__name__)
 
@@ -102,6 +126,8 @@ def create_media():
         search['safe'] = False
         if not Search.add(**search):
             return jsonify(error='failed to create search %s' % search)
+        add_search_tokens(Search, {'name': search['name']})
+        Version.bump('search', 'search_keys')
         return jsonify(result=True)
 
     name = data.get('name')
@@ -143,6 +169,8 @@ def create_media():
                 search[attr] = int(val) if val else None
         if not Search.add(**search):
             return jsonify(error='failed to create search %s' % search)
+        add_search_tokens(Search, {'name': search['name']})
+        Version.bump('search', 'search_keys')
 
     return jsonify(result=True)
 
@@ -177,16 +205,11 @@ def create_similar():
     similar['langs'] = data.get('langs') or []
     if not SimilarSearch.add(**similar):
         return jsonify(error='failed to create similar %s' % similar)
+    add_search_tokens(SimilarSearch, {'name': similar['name']})
+    Version.bump('similar', 'similar_keys')
 
     return jsonify(result=True)
 
-def _get_search_spec(query):
-    query_ = {
-        '$regex': r'(^|[\W_]+)%s([\W_]+|$)' % '[\W_]+'.join(clean(query, 1).split()),
-        '$options': 'i',
-        }
-    return {'$or': [{f: query_} for f in SEARCH_FIELDS]}
-
 def _get_search_title(search):
     res = search['name']
     if search.get('episode'):
@@ -198,58 +221,18 @@ def _get_search_title(search):
         res = '%s - %s' % (res, search['album'])
     return res
 
-def _has_search(cache, obj):
-    if 'searches' not in cache:
-        cache['searches'] = list(Search.find())
-    for res in cache['searches']:
-        if res['name'] == obj['name'] \
-                and res['category'] == obj['category'] \
-                and res.get('season') == obj.get('season') \
-                and res.get('episode') == obj.get('episode') \
-                and res.get('album') == obj.get('album'):
-            return True
-    return False
-
-def _has_similar(cache, obj):
-    if 'similar' not in cache:
-        cache['similar'] = list(SimilarSearch.find())
-    for res in cache['similar']:
-        if res['name'] == obj['name'] \
-                and res['category'] == obj['category']:
-            return True
-    return False
-
-def _get_extra(extra):
-    res = {}
-    for section, info in extra.items():
-        if not info:
-            continue
-        res.setdefault(section, {})
-        for key in EXTRA_FIELDS:
-            if key in info:
-                res[section][key] = info[key]
-    return res
+def _get_search_key(obj):
+    return (obj['name'], obj['category'], obj.get('season'),
+            obj.get('episode'), obj.get('album'))
 
-def _get_thumbnail_url(extra, category):
-    if category == 'music':
-        for section in ('sputnikmusic', 'lastfm'):
-            url = extra.get(section, {}).get('url_thumbnail')
-            if url:
-                return url
+def _get_search_keys(names):
+    return set([_get_search_key(r) for r in Search.find(
+            {'name': {'$in': names}},
+            fields=['name', 'category', 'season', 'episode', 'album'])])
 
-    elif category in ('movies', 'tv', 'anime'):
-        for section in ('rottentomatoes', 'tvrage'):
-            url = extra.get(section, {}).get('url_thumbnail')
-            if url:
-                return url
-
-    return extra.get('youtube', {}).get('urls_thumbnails', [None])[0]
-
-def _get_video_id(extra):
-    url = extra.get('youtube', {}).get('url_watch')
-    if url:
-        qs = parse_qs(urlparse(url).query)
-        return qs['v'][0]
+def _get_similar_keys(names):
+    return set([(r['name'], r['category']) for r in SimilarSearch.find(
+            {'name': {'$in': names}}, fields=['name', 'category'])])
 
 def _get_object(obj, type, **kwargs):
     if type in ('search', 'similar'):
@@ -259,18 +242,19 @@ def _get_object(obj, type, **kwargs):
         category = obj['info']['subtype']
         date = obj['date']
 
-    extra = obj.get('extra', {})
+    summary = obj.pop('summary', None) or {}
+    obj.pop('search_tokens', None)
     res = {
         'id': obj['_id'],
         'type': type,
         'category': category,
         'source': obj.get('source'),
         'date': date,
-        'extra': _get_extra(extra),
+        'extra': summary.get('extra', {}),
         'src': obj.get('src', {}),
         'rating': obj.get('rating'),
-        'url_thumbnail': _get_thumbnail_url(extra, category),
-        'video_id': _get_video_id(extra),
+        'url_thumbnail': summary.get('url_thumbnail'),
+        'video_id': summary.get('video_id'),
         'has_search': kwargs.get('has_search', False),
         'has_similar': kwargs.get('has_similar', False),
         }
@@ -279,8 +263,7 @@ def _get_object(obj, type, **kwargs):
         res['obj'] = obj
     else:
         if type == 'media':
-            paths = [os.path.dirname(f) for f in obj.get('files', [])]
-            res['paths'] = sorted(list(set(paths)))
+            res['paths'] = summary.get('paths', [])
             res['urls'] = obj.get('urls', [])
         elif type == 'release':
             res['release'] = obj.get('release')
@@ -297,11 +280,10 @@ def _get_object(obj, type, **kwargs):
 
     return res
 
-@app.route('/media/list/<type>/<int:skip>/<int:limit>',
-        methods=['GET', 'OPTIONS'])
-@crossdomain(origin='*')
-def list_media(type, skip, limit):
-    cache = {}
+def _get_list_spec(type, text=False):
+    '''Get the spec of the listed objects, using the text index
+    to match the query words if text is True.
+    '''
     spec = {}
 
     category = request.args.get('category')
@@ -312,45 +294,137 @@ def list_media(type, skip, limit):
             spec['info.subtype'] = category
     query = request.args.get('query')
     if query:
-        spec.update(_get_search_spec(query))
+        if text:
+            spec['$text'] = {'$search': query}
+        else:
+            spec.update(get_search_spec(query))
+    return spec
 
-    sort = request.args.get('sort', 'date')
-    if sort == 'name':
-        sort = [('name', ASCENDING)]
-    elif sort == 'rating':
-        sort = [('rating', DESCENDING)]
-    else:
-        sort = [('date', DESCENDING), ('created', DESCENDING)]
+def _get_list_sort_name():
+    name = request.args.get('sort')
+    return name if name in LIST_SORTS else LIST_SORT_DEF
 
-    params = {'sort': sort, 'skip': skip, 'limit': limit}
-    items = []
+def _get_list_sort():
+    return LIST_SORTS[_get_list_sort_name()]
 
-    if type == 'media':
-        for res in Media.find(spec, **params):
-            search = Media.get_search(res)
-            items.append(_get_object(res, type=type,
-                    has_search=_has_search(cache, search),
-                    has_similar=_has_similar(cache, search)))
+def _get_model(type):
+    return {
+        'media': Media,
+        'release': Release,
+        'search': Search,
+        'similar': SimilarSearch,
+        }.get(type)
+
+def _get_list_fields(type, sort):
+    '''Get the projection of the fields rendered by the list,
+    including the sort keys used by the cursor and the $meta ones.
+    '''
+    fields = LIST_FIELDS.get(type)
+    if fields:
+        res = dict([(f, True) for f in fields])
+    else:
+        res = dict([(f, False) for f in LIST_FIELDS_EXCLUDED])
+    for key, direction in sort:
+        if isinstance(direction, dict):
+            res[key] = direction
+        elif fields:
+            res[key] = True
+    return res
 
-    elif type == 'release':
-        for res in Release.find(spec, **params):
-            search = Release.get_search(res)
-            items.append(_get_object(res, type=type,
-                    has_search=_has_search(cache, search),
-                    has_similar=_has_similar(cache, search)))
+def _set_summaries(model, objs):
+    '''Set the summary of the objects stored before it was maintained;
+    the extra worker stores it.
+    '''
+    ids = [r['_id'] for r in objs if 'summary' not in r]
+    if not ids:
+        return
+    summaries = dict([(r['_id'], get_summary(r)) for r in model.find(
+            {'_id': {'$in': ids}}, fields=SUMMARY_FIELDS)])
+    for obj in objs:
+        if obj['_id'] in summaries:
+            obj['summary'] = summaries[obj['_id']]
+
+def _find_objects(type, spec, sort, **params):
+    '''Get a list of objects and their searches.
+    '''
+    model = _get_model(type)
+    if not model:
+        return []
+
+    objs = list(model.find(spec, sort=sort,
+            fields=_get_list_fields(type, sort), **params))
+    _set_summaries(model, objs)
+    if type in ('media', 'release'):
+        return [(r, model.get_search(r)) for r in objs]
+    return [(r, r) for r in objs]
+
+def ensure_indexes():
+    '''Create the indexes of the list queries.
+    '''
+    for type in ('media', 'release', 'search', 'similar'):
+        model = _get_model(type)
+        for sort in LIST_SORTS.values():
+            model.ensure_index(sort)
+        model.ensure_index('search_tokens')
+        model.ensure_index(TEXT_INDEX, weights=TEXT_WEIGHTS,
+                default_language='none')
+    Search.ensure_index('name')
+    SimilarSearch.ensure_index('name')
+
+def _get_list_versions(type, **kwargs):
+    return LIST_VERSIONS.get(type, ())
+
+def _get_items(type, objs):
+    names = list(set([s['name'] for r, s in objs]))
+    searches = _get_search_keys(names) if type in ('media', 'release') else set()
+    similars = _get_similar_keys(names) if type != 'similar' else set()
 
-    elif type == 'search':
-        for res in Search.find(spec, **params):
-            items.append(_get_object(res, type=type,
-                    has_search=True,
-                    has_similar=_has_similar(cache, res)))
+    items = []
+    for res, search in objs:
+        items.append(_get_object(res, type=type,
+                has_search=type == 'search' or _get_search_key(search) in searches,
+                has_similar=type == 'similar' or (search['name'], search['category']) in similars))
+    return items
 
-    elif type == 'similar':
-        for res in SimilarSearch.find(spec, **params):
-            items.append(_get_object(res, type=type,
-                    has_similar=True))
+@app.route('/media/list/<type>/<int:skip>/<int:limit>',
+        methods=['GET', 'OPTIONS'])
+@crossdomain(origin='*')
+@cached(_get_list_versions)
+def list_media(type, skip, limit):
+    '''List objects, ranking them by the text index score
+    when sorting by relevance. The relevance sort only matches
+    whole query words, any of them, unlike the prefix matching
+    of the other sorts.
+    '''
+    if request.args.get('query') and request.args.get('sort') == 'relevance':
+        spec = _get_list_spec(type, text=True)
+        sort = RELEVANCE_SORT
+    else:
+        spec = _get_list_spec(type)
+        sort = _get_list_sort()
+    objs = _find_objects(type, spec, sort, skip=skip, limit=limit)
+    return serialize({'result': _get_items(type, objs)})
 
-    return serialize({'result': items})
+@app.route('/media/list/<type>/<int:limit>', methods=['GET', 'OPTIONS'])
+@crossdomain(origin='*')
+@cached(_get_list_versions)
+def list_media_cursor(type, limit):
+    '''List objects after the cursor argument returned
+    by the previous page, if any.
+    '''
+    spec = _get_list_spec(type)
+    sort_name = _get_list_sort_name()
+    sort = LIST_SORTS[sort_name]
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            spec = {'$and': [spec, get_cursor_spec(cursor, sort_name, sort)]}
+        except (TypeError, ValueError, IndexError, KeyError):
+            return jsonify(error='invalid cursor')
+
+    objs = _find_objects(type, spec, sort, limit=limit)
+    cursor = get_cursor(objs[-1][0], sort_name, sort) if objs else None
+    return serialize({'result': _get_items(type, objs), 'cursor': cursor})
 
 @app.route('/media/search/results', methods=['POST', 'OPTIONS'])
 @crossdomain(origin='*')
@@ -408,7 +482,10 @@ def update_search():
     for attr in ('season', 'episode'):
         val = data.get(attr)
         info[attr] = int(val) if val else None
-    Search.update({'_id': id}, {'$set': info}, safe=True)
+    Search.update({'_id': id}, {'$set': info, '$inc': {'version': 1}},
+            safe=True)
+    update_search_tokens(Search, {'_id': id})
+    Version.bump('search', 'search_keys')
 
     return jsonify(result=True)
 
@@ -422,8 +499,11 @@ def update_search_safe():
     safe = data.get('safe')
     if not isinstance(safe, bool):
         return jsonify(error='invalid safe value')
-    Search.update({'_id': id}, {'$set': {'safe': safe, 'session': {}}},
-            safe=True)
+    Search.update({'_id': id}, {
+            '$set': {'safe': safe, 'session': {}},
+            '$inc': {'version': 1},
+            }, safe=True)
+    Version.bump('search')
     return jsonify(result=True)
 
 @app.route('/media/update/similar', methods=['POST', 'OPTIONS'])
@@ -447,6 +527,8 @@ def update_similar():
         'recurrence': int(data['recurrence']),
         }
     SimilarSearch.update({'_id': id}, {'$set': info}, safe=True)
+    update_search_tokens(SimilarSearch, {'_id': id})
+    Version.bump('similar', 'similar_keys')
 
     return jsonify(result=True)
 
@@ -456,8 +538,11 @@ def reset_search():
     data = request.json
     if not data.get('id'):
         return jsonify(error='missing id')
-    Search.update({'_id': ObjectId(data['id'])},
-            {'$set': {'session': {}}}, safe=True)
+    Search.update({'_id': ObjectId(data['id'])}, {
+            '$set': {'session': {}},
+            '$inc': {'version': 1},
+            }, safe=True)
+    Version.bump('search')
     return jsonify(result=True)
 
 @app.route('/media/share', methods=['POST', 'OPTIONS'])
@@ -481,6 +566,7 @@ def share_media():
             category=media['info']['subtype'],
             parameters=parameters):
         return jsonify(error='failed to create sync')
+    Version.bump('sync')
 
     return jsonify(result=True)
 
@@ -506,6 +592,9 @@ def remove_media():
         SimilarSearch.remove(spec)
     else:
         return jsonify(error='unknown type %s' % type)
+    Version.bump(type)
+    if type in ('search', 'similar'):
+        Version.bump('%s_keys' % type)
 
     return jsonify(result=True)
 
@@ -547,6 +636,7 @@ def create_sync():
         return jsonify(error=str(e))
     if not Sync.add(**sync):
         return jsonify(error='failed to create sync')
+    Version.bump('sync')
     return jsonify(result=True)
 
 def _get_user(user):
@@ -558,6 +648,7 @@ def _get_user(user):
 
 @app.route('/sync/list', methods=['GET', 'OPTIONS'])
 @crossdomain(origin='*')
+@cached('sync', 'media', 'user', 'settings')
 def list_syncs():
     now = datetime.utcnow()
     sync_recurrence = timedelta(minutes=Settings.get_settings('sync')['recurrence'])
@@ -585,6 +676,7 @@ def list_syncs():
 
 @app.route('/user/list', methods=['GET', 'OPTIONS'])
 @crossdomain(origin='*')
+@cached('user')
 def list_users():
     users = [_get_user(u) for u in get_users()]
     return serialize({'result': users})
@@ -601,6 +693,7 @@ def update_sync():
         return jsonify(error=str(e))
     Sync.update({'_id': ObjectId(data['_id'])},
             {'$set': sync}, safe=True)
+    Version.bump('sync')
     return jsonify(result=True)
 
 @app.route('/sync/reset', methods=['POST', 'OPTIONS'])
@@ -611,6 +704,7 @@ def reset_sync():
         return jsonify(error='missing id')
     Sync.update({'_id': ObjectId(data['id'])},
             {'$set': {'reserved': None}}, safe=True)
+    Version.bump('sync')
     return jsonify(result=True)
 
 @app.route('/sync/remove', methods=['POST', 'OPTIONS'])
@@ -620,6 +714,7 @@ def remove_sync():
     if not data.get('id'):
         return jsonify(error='missing id')
     Sync.remove({'_id': ObjectId(data['id'])})
+    Version.bump('sync')
     return jsonify(result=True)
 
 
@@ -646,6 +741,7 @@ def _sanitize_settings(settings):
 
 @app.route('/settings/list', methods=['GET', 'OPTIONS'])
 @crossdomain(origin='*')
+@cached('settings')
 def list_settings():
     settings = {}
     for section in ('media_filters', 'search_filters', 'media_langs',
@@ -663,6 +759,7 @@ def update_settings():
     _sanitize_settings(data)
     for section, settings in data.items():
         Settings.set_settings(section, settings, overwrite=True)
+    Version.bump('settings')
     return jsonify(result=True)
 
 
@@ -679,6 +776,7 @@ def get_google_auth_url():
 def google_auth_callback():
     token = request.args.get('code')
     res = token and set_credentials(token)
+    Version.bump('settings')
     return 'OK' if res else 'OAuth flow error'
 
 @app.route('/google_api/auth_token', methods=['POST', 'OPTIONS'])
@@ -686,4 +784,5 @@ def google_auth_callback():
 def validate_google_auth_token():
     token = request.json.get('token')
     res = token and set_credentials(token)
+    Version.bump('settings')
     return jsonify(result=res)
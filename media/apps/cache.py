@@ -0,0 +1,88 @@
+from datetime import datetime, timedelta
+from functools import wraps
+from hashlib import sha1
+from threading import Lock
+
+from flask import request, make_response
+
+from media.model.version import Version
+
+
+DELTA_CACHE = timedelta(minutes=1)
+CACHE_MAX = 500
+
+
+class ResponseCache(object):
+    '''Cache of the responses, valid as long as the versions
+    of the data they depend on do not change.
+    '''
+    def __init__(self, delta=DELTA_CACHE, size_max=CACHE_MAX):
+        self.delta = delta
+        self.size_max = size_max
+        self.entries = {}
+        self.lock = Lock()
+
+    def get(self, key, versions):
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry and entry['versions'] == versions \
+                and entry['expires'] > datetime.utcnow():
+            return entry
+
+    def set(self, key, versions, response):
+        body = response.data
+        entry = {
+            'versions': versions,
+            'expires': datetime.utcnow() + self.delta,
+            'etag': sha1(body).hexdigest(),
+            'body': body,
+            'mimetype': response.mimetype,
+            }
+        with self.lock:
+            if len(self.entries) >= self.size_max:
+                self.entries.clear()
+            self.entries[key] = entry
+        return entry
+
+
+cache = ResponseCache()
+
+
+def _get_response(entry):
+    if request.if_none_match.contains(entry['etag']):
+        response = make_response('', 304)
+    else:
+        response = make_response(entry['body'])
+        response.mimetype = entry['mimetype']
+    response.set_etag(entry['etag'])
+    return response
+
+def cached(*names):
+    '''Cache the GET responses by path and arguments and answer
+    conditional requests while the versions of the names are unchanged.
+
+    The names can also be given by a callable called with
+    the view arguments.
+
+    The entries also expire after DELTA_CACHE to catch the changes
+    made outside of this package.
+    '''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET':
+                return func(*args, **kwargs)
+            key = (request.path, tuple(sorted(request.args.items(multi=True))))
+            names_ = names
+            if len(names) == 1 and callable(names[0]):
+                names_ = names[0](*args, **kwargs)
+            versions = Version.get_versions(names_)
+            entry = cache.get(key, versions)
+            if not entry:
+                response = make_response(func(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                entry = cache.set(key, versions, response)
+            return _get_response(entry)
+        return wrapper
+    return decorator
@@ -0,0 +1,82 @@
+from datetime import datetime, timedelta
+import logging
+
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+
+from media import settings, get_factory
+from media.model.job import Job
+
+
+JOBS_QUEUED_MAX = 50
+TIMEOUT_DEF = 3600  # seconds
+DELTA_QUEUED_MAX = timedelta(hours=1)
+
+logger = logging.getLogger(__name__)
+
+
+def _get_key(target, args):
+    '''Get the job key, identical for str and unicode args
+    since the factory stores the jobs args in mongo.
+    '''
+    return u'%s:%s' % (target, u','.join([unicode(a) for a in args]))
+
+def _remove_expired():
+    Job.ensure_index([('target', ASCENDING), ('started', ASCENDING)])
+    Job.ensure_index([('expires', ASCENDING)])
+    Job.remove({'expires': {'$lt': datetime.utcnow()}}, safe=True)
+
+def get_jobs_count(target=None):
+    '''Get the number of queued and running jobs.
+    '''
+    _remove_expired()
+    spec = {'target': target} if target else {}
+    running = Job.find(dict(spec, started={'$ne': None})).count()
+    return {
+        'queued': Job.find(spec).count() - running,
+        'running': running,
+        }
+
+def get_free_slots(target, limit):
+    '''Get the number of jobs which can be added for the target.
+    '''
+    res = get_jobs_count()
+    if res['queued'] >= JOBS_QUEUED_MAX:
+        logger.debug('skipped %s: %s queued jobs', target, res['queued'])
+        return 0
+    res = get_jobs_count(target)
+    return max(limit - res['queued'] - res['running'], 0)
+
+def add_job(target, args=(), timeout=None, **kwargs):
+    '''Add a job unless the same job is already queued or running.
+
+    :return: True if the job has been added
+    '''
+    _remove_expired()
+    now = datetime.utcnow()
+    timeout_ = timedelta(seconds=timeout or TIMEOUT_DEF)
+    key = _get_key(target, args)
+    try:
+        Job.insert({
+                '_id': key,
+                'target': target,
+                'created': now,
+                'started': None,
+                'expires': now + DELTA_QUEUED_MAX + timeout_,
+                }, safe=True)
+    except DuplicateKeyError:
+        return False
+
+    get_factory().add(target='%s.dispatch.run_job' % settings.PACKAGE_NAME,
+            args=(key, target, tuple(args)), timeout=timeout, **kwargs)
+    return True
+
+def run_job(key, target, args):
+    Job.update({'_id': key},
+            {'$set': {'started': datetime.utcnow()}}, safe=True)
+    try:
+        module, func = target.rsplit('.', 1)
+        module = __import__(module, globals(), locals(), [func], -1)
+        return getattr(module, func)(*args)
+    finally:
+        Job.remove({'_id': key}, safe=True)
@@ -0,0 +1,14 @@
+from mediacore.utils.db import get_db
+
+
+class ModelType(type):
+
+    def __getattr__(cls, attr):
+        return getattr(get_db()[cls.COL], attr)
+
+
+class Model(object):
+    '''Proxy to the collection of the model.
+    '''
+    __metaclass__ = ModelType
+    COL = None
@@ -0,0 +1,5 @@
+from media.model import Model
+
+
+class DirSize(Model):
+    COL = 'dir_sizes'
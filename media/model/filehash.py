@@ -0,0 +1,5 @@
+from media.model import Model
+
+
+class FileHash(Model):
+    COL = 'file_hashes'
@@ -0,0 +1,5 @@
+from media.model import Model
+
+
+class HostState(Model):
+    COL = 'host_states'
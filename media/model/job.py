@@ -0,0 +1,5 @@
+from media.model import Model
+
+
+class Job(Model):
+    COL = 'jobs'
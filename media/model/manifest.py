@@ -0,0 +1,5 @@
+from media.model import Model
+
+
+class Manifest(Model):
+    COL = 'manifests'
@@ -0,0 +1,78 @@
+from datetime import datetime
+
+from pymongo.errors import DuplicateKeyError
+
+from media.model import Model
+
+
+RETRIES_MAX = 5
+
+
+class Quota(Model):
+    '''Per plugin rate limits shared by the jobs, implemented as
+    token buckets with a cool down on quota errors.
+    '''
+    COL = 'quotas'
+
+    @classmethod
+    def _get_tokens(cls, doc, capacity, delta, now):
+        if not doc:
+            return capacity
+        elapsed = (now - doc['updated']).total_seconds()
+        refill = elapsed * capacity / delta.total_seconds()
+        return min(capacity, doc['tokens'] + refill)
+
+    @classmethod
+    def available(cls, name, capacity=None, delta=None):
+        '''Check if the plugin is not blocked and has tokens left.
+        '''
+        doc = cls.find_one({'_id': name})
+        now = datetime.utcnow()
+        if doc and doc.get('blocked') and doc['blocked'] > now:
+            return False
+        if capacity is None:
+            return True
+        return cls._get_tokens(doc, capacity, delta, now) >= 1
+
+    @classmethod
+    def consume(cls, name, capacity=None, delta=None):
+        '''Take a token from the plugin bucket.
+
+        :param capacity: number of calls allowed per delta
+        :return: True if the call is allowed
+        '''
+        for i in range(RETRIES_MAX):
+            doc = cls.find_one({'_id': name})
+            now = datetime.utcnow()
+            if doc and doc.get('blocked') and doc['blocked'] > now:
+                return False
+            if capacity is None:
+                return True
+            tokens = cls._get_tokens(doc, capacity, delta, now)
+            if tokens < 1:
+                return False
+
+            info = {'tokens': tokens - 1, 'updated': now}
+            if not doc:
+                try:
+                    cls.insert(dict(info, _id=name), safe=True)
+                    return True
+                except DuplicateKeyError:
+                    continue
+            res = cls.update({'_id': name, 'updated': doc['updated']},
+                    {'$set': info}, safe=True)
+            if not res or res.get('n'):
+                return True
+        return False
+
+    @classmethod
+    def block(cls, name, delta):
+        '''Block the plugin for delta (e.g.: when its quota is reached).
+        '''
+        cls.update({'_id': name},
+                {'$set': {
+                    'blocked': datetime.utcnow() + delta,
+                    'tokens': 0,
+                    'updated': datetime.utcnow(),
+                    }},
+                upsert=True, safe=True)
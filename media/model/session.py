@@ -0,0 +1,5 @@
+from media.model import Model
+
+
+class Session(Model):
+    COL = 'sessions'
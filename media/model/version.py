@@ -0,0 +1,20 @@
+from media.model import Model
+
+
+class Version(Model):
+    '''Counters of the data changes, used to validate
+    the cached API responses.
+    '''
+    COL = 'versions'
+
+    @classmethod
+    def bump(cls, *names):
+        for name in names:
+            cls.update({'_id': name}, {'$inc': {'version': 1}},
+                    upsert=True, safe=True)
+
+    @classmethod
+    def get_versions(cls, names):
+        res = dict([(r['_id'], r['version'])
+                for r in cls.find({'_id': {'$in': list(names)}})])
+        return tuple([res.get(n, 0) for n in names])
@@ -2,6 +2,7 @@ PACKAGE_NAME = 'media'
 DB_NAME = 'media'
 API_PORT = 9000
 FILES_COUNT_MIN = {'music': 3}
+OPENSUBTITLES_USER_AGENT = None    # registered user agent enabling the hash searches
 
 # Logging
 LOG_FILE = '/home/user/log/media.log'
@@ -9,6 +10,9 @@ LOG_FORMAT = '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
 LOG_SIZE = 100000   # bytes
 LOG_COUNT = 100
 
+# Local secret of the sessions credentials digests
+SECRET_FILE = '/home/user/.media_secret'
+
 
 # Import local settings
 try:
@@ -0,0 +1,35 @@
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+
+from bson import json_util
+from pymongo import ASCENDING
+
+
+def get_cursor(obj, name, sort):
+    '''Get the cursor of the object in the sort, named name.
+    '''
+    values = [obj.get(k) for k, d in sort]
+    return urlsafe_b64encode(json_util.dumps([name, values]))
+
+def get_cursor_spec(cursor, name, sort):
+    '''Get the spec of the objects following the cursor in the sort order.
+
+    :raise ValueError: if the cursor was not created for this sort
+    '''
+    res = json_util.loads(urlsafe_b64decode(str(cursor)))
+    if not isinstance(res, list) or len(res) != 2 or res[0] != name:
+        raise ValueError('invalid cursor %s' % cursor)
+    values = res[1]
+    if not isinstance(values, list) or len(values) != len(sort):
+        raise ValueError('invalid cursor %s' % cursor)
+    clauses = []
+    for i, (key, direction) in enumerate(sort):
+        prefix = dict([(k, values[j]) for j, (k, d) in enumerate(sort[:i])])
+        value = values[i]
+        # Null values are sorted first
+        if direction == ASCENDING:
+            cond = {'$ne': None} if value is None else {'$gt': value}
+            clauses.append(dict(prefix, **{key: cond}))
+        elif value is not None:
+            clauses.append(dict(prefix, **{key: {'$lt': value}}))
+            clauses.append(dict(prefix, **{key: None}))
+    return {'$or': clauses}
@@ -0,0 +1,44 @@
+import os
+import struct
+from datetime import datetime
+
+from media.model.filehash import FileHash
+
+
+CHUNK_SIZE = 65536  # bytes
+
+
+def get_moviehash(file):
+    '''Get the OpenSubtitles hash of a file: its size plus the sum
+    of the 64 bits words of its first and last 64 KB.
+    '''
+    size = os.path.getsize(file)
+    if size < CHUNK_SIZE * 2:
+        return
+    res = size
+    with open(file, 'rb') as fd:
+        for offset in (0, size - CHUNK_SIZE):
+            fd.seek(offset)
+            for val in struct.unpack('<%dQ' % (CHUNK_SIZE / 8), fd.read(CHUNK_SIZE)):
+                res = (res + val) & 0xFFFFFFFFFFFFFFFF
+    return '%016x' % res
+
+def get_hash(file):
+    '''Get the file hash and size, from the cache if the file
+    inode, size and modification time have not changed.
+    '''
+    st = os.stat(file)
+    key = '%s:%s:%s:%s' % (st.st_dev, st.st_ino, st.st_size, int(st.st_mtime))
+    res = FileHash.find_one({'_id': key})
+    if res:
+        return res['hash'], st.st_size
+
+    hash = get_moviehash(file)
+    if hash:
+        FileHash.save({
+                '_id': key,
+                'file': file,
+                'hash': hash,
+                'created': datetime.utcnow(),
+                }, safe=True)
+    return hash, st.st_size
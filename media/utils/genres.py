@@ -0,0 +1,27 @@
+import re
+
+
+GENRE_SECTIONS = {
+    'movies': ['imdb'],
+    'tv': ['tvrage'],
+    'music': ['sputnikmusic', 'lastfm'],
+    }
+
+
+def normalize_genre(genre):
+    return ' '.join(re.split(r'[\W_]+', genre.lower())).strip()
+
+def get_genres(extra, category):
+    '''Get the normalized genre tags: the genres and their words.
+    '''
+    res = set()
+    for section in GENRE_SECTIONS.get(category, []):
+        genres = extra.get(section, {}).get('genre') or []
+        if not isinstance(genres, (list, tuple)):
+            genres = [genres]
+        for genre in genres:
+            genre = normalize_genre(genre)
+            if genre:
+                res.add(genre)
+                res.update(genre.split())
+    return sorted(res)
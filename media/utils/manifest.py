@@ -0,0 +1,32 @@
+import os.path
+
+
+def plan_sync(src, root_names, dst_entries, get_size):
+    '''Get the directories to transfer and the destination
+    entries to remove.
+
+    Directories already at the user root path are skipped,
+    as well as directories successfully transferred to the destination
+    unless their size has changed since.
+
+    :param src: list of local directories
+    :param root_names: list of names at the user root path
+    :param dst_entries: dict {name: size} at the destination path,
+        the size being None if the directory was not transferred
+        successfully
+    :param get_size: callable returning the size of a local directory
+    :return: tuple (list of (directory, size) to transfer,
+        list of destination names to remove)
+    '''
+    src_dirs = dict([(os.path.basename(s), s) for s in src])
+    for name in root_names:
+        src_dirs.pop(name, None)
+
+    to_remove = [n for n in dst_entries if n not in src_dirs]
+    to_transfer = []
+    for name, dir_ in src_dirs.items():
+        size = get_size(dir_)
+        if dst_entries.get(name) == size:
+            continue
+        to_transfer.append((dir_, size))
+    return to_transfer, to_remove
@@ -0,0 +1,76 @@
+import xmlrpclib
+import socket
+import logging
+
+from mediacore.web import RateLimitReached
+from mediacore.web.opensubtitles import Opensubtitles as BaseOpensubtitles
+
+from media import settings
+
+
+API_URL = 'https://api.opensubtitles.org/xml-rpc'
+API_TIMEOUT = 30    # seconds
+RESULTS_MAX = 10
+
+logger = logging.getLogger(__name__)
+
+
+class _TimeoutTransport(xmlrpclib.SafeTransport):
+
+    def make_connection(self, host):
+        conn = xmlrpclib.SafeTransport.make_connection(self, host)
+        conn.timeout = API_TIMEOUT
+        return conn
+
+
+class Opensubtitles(BaseOpensubtitles):
+    '''Opensubtitles plugin also searching by file hash through
+    the xml-rpc api, the results being subtitles pages urls
+    downloaded by the plugin.
+
+    Hash searches require a registered OPENSUBTITLES_USER_AGENT.
+    '''
+
+    def __init__(self, **kwargs):
+        BaseOpensubtitles.__init__(self, **kwargs)
+        self.api_username = kwargs.get('username') or ''
+        self.api_password = kwargs.get('password') or ''
+        self.api = xmlrpclib.ServerProxy(API_URL,
+                transport=_TimeoutTransport(), allow_none=True)
+        self.api_token = None
+
+    @property
+    def by_hash(self):
+        return bool(settings.OPENSUBTITLES_USER_AGENT)
+
+    def _check_status(self, res):
+        status = res.get('status', '')
+        if status[:3] in ('407', '429'):
+            raise RateLimitReached(status)
+        if not status.startswith('200'):
+            raise Exception('opensubtitles api error: %s' % status)
+
+    def _login(self):
+        if not self.api_token:
+            res = self.api.LogIn(self.api_username, self.api_password,
+                    'en', settings.OPENSUBTITLES_USER_AGENT)
+            self._check_status(res)
+            self.api_token = res['token']
+        return self.api_token
+
+    def results_by_hash(self, hash, size, lang):
+        '''Get the subtitles urls matching the file hash and size.
+        '''
+        try:
+            token = self._login()
+            res = self.api.SearchSubtitles(token, [{
+                    'moviehash': hash,
+                    'moviebytesize': str(size),
+                    'sublanguageid': lang,
+                    }], {'limit': RESULTS_MAX})
+        except (xmlrpclib.Error, socket.error), e:
+            logger.error('failed to search opensubtitles by hash %s: %s', hash, str(e))
+            return []
+        self._check_status(res)
+        return [r['SubtitlesLink'] for r in res.get('data') or []
+                if r.get('SubtitlesLink')]
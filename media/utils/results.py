@@ -0,0 +1,95 @@
+import sys
+import threading
+from Queue import Queue, Full, Empty
+import logging
+
+from mediacore.web.search import results as iter_results
+
+
+PAGE_SIZE = 20  # results per page of the search plugins
+PUT_TIMEOUT = 1     # seconds
+
+logger = logging.getLogger(__name__)
+
+
+class _End(object):
+
+    def __init__(self, exc_info=None):
+        self.exc_info = exc_info
+
+
+class _Fetcher(threading.Thread):
+
+    def __init__(self, iterable, window):
+        super(_Fetcher, self).__init__()
+        self.daemon = True
+        self.iterable = iterable
+        self.queue = Queue(maxsize=window)
+        self.stopped = threading.Event()
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=PUT_TIMEOUT)
+                return True
+            except Full:
+                continue
+
+    def run(self):
+        end = _End()
+        try:
+            for item in self.iterable:
+                if not self._put(item):
+                    break
+        except Exception:
+            end = _End(sys.exc_info())
+        finally:
+            close = getattr(self.iterable, 'close', None)
+            if close:
+                close()
+        self._put(end)
+
+    def stop(self):
+        self.stopped.set()
+        # Unblock the fetcher if it is waiting on a full queue
+        try:
+            while True:
+                self.queue.get_nowait()
+        except Empty:
+            pass
+
+
+def prefetch(iterable, window=PAGE_SIZE):
+    '''Iterate over an iterable while fetching up to window items
+    ahead in a background thread.
+
+    Items are yielded in the iterable order and the fetch is stopped
+    if the consumer fails while processing an item.
+    '''
+    fetcher = _Fetcher(iterable, window)
+    fetcher.start()
+    try:
+        while True:
+            item = fetcher.queue.get()
+            if isinstance(item, _End):
+                if item.exc_info:
+                    raise item.exc_info[0], item.exc_info[1], item.exc_info[2]
+                break
+            yield item
+    finally:
+        fetcher.stop()
+
+def results(query, window=PAGE_SIZE, **kwargs):
+    '''Get search results, fetching at most the next page while the
+    current results are being processed.
+
+    The plugins are iterated by mediacore, so the pages are fetched
+    ahead sequentially and not concurrently across plugins.
+
+    :param window: number of results fetched ahead, 0 to fetch the
+        pages only when they are consumed
+    '''
+    res = iter_results(query, **kwargs)
+    if not window or kwargs.get('pages_max') == 1:
+        return res
+    return prefetch(res, window=window)
@@ -0,0 +1,58 @@
+import re
+
+
+SEARCH_FIELDS = ('name', 'files', 'extra.imdb.director', 'extra.imdb.stars',
+    'extra.imdb.genre', 'extra.tvrage.genre', 'extra.lastfm.genre',
+    'extra.sputnikmusic.genre', 'extra.tvrage.classification')
+
+
+def get_tokens(text):
+    '''Get the normalized words of a text.
+    '''
+    return [t for t in re.split(r'[\W_]+', text.lower(), flags=re.U) if t]
+
+def _get_values(obj, field):
+    res = [obj]
+    for key in field.split('.'):
+        res = [r.get(key) for r in res if isinstance(r, dict)]
+    values = []
+    for val in res:
+        if isinstance(val, (list, tuple)):
+            values.extend(val)
+        elif val is not None:
+            values.append(val)
+    return [v for v in values if isinstance(v, basestring)]
+
+def get_search_tokens(obj):
+    '''Get the tokens of the object SEARCH_FIELDS values.
+    '''
+    res = set()
+    for field in SEARCH_FIELDS:
+        for value in _get_values(obj, field):
+            res.update(get_tokens(value))
+    return sorted(res)
+
+def update_search_tokens(model, spec):
+    '''Update the search tokens of the objects matching the spec.
+    '''
+    for obj in model.find(spec, fields=list(SEARCH_FIELDS)):
+        model.update({'_id': obj['_id']},
+                {'$set': {'search_tokens': get_search_tokens(obj)}},
+                safe=True)
+
+def add_search_tokens(model, spec):
+    '''Set the search tokens of the new objects matching the spec.
+    '''
+    update_search_tokens(model,
+            dict(spec, search_tokens={'$exists': False}))
+
+def get_search_spec(query):
+    '''Get the spec of the objects with tokens starting
+    with each of the query words.
+    '''
+    tokens = get_tokens(query)
+    if not tokens:
+        return {}
+    return {'search_tokens': {
+            '$all': [re.compile('^%s' % re.escape(t)) for t in tokens],
+            }}
@@ -0,0 +1,118 @@
+import os
+import threading
+from datetime import datetime, timedelta
+from hashlib import sha256
+import hmac
+import logging
+
+from media import settings
+from media.model.session import Session
+
+
+DELTA_EXPIRE = timedelta(hours=6)
+SECRET_SIZE = 32    # bytes
+
+logger = logging.getLogger(__name__)
+
+
+def get_secret():
+    '''Get the local secret, created on first use.
+    '''
+    try:
+        fd = os.open(settings.SECRET_FILE,
+                os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+    except OSError:
+        with open(settings.SECRET_FILE, 'rb') as fd:
+            return fd.read()
+    secret = os.urandom(SECRET_SIZE)
+    with os.fdopen(fd, 'wb') as fd:
+        fd.write(secret)
+    return secret
+
+
+class SessionPool(object):
+    '''Pool of authenticated clients for credentialed sources.
+
+    Clients are keyed by (source, username, password), so a credentials
+    change creates a new client. The sessions are shared across the job
+    processes through their cookie file, valid as long as the session
+    record is not expired and matches the credentials digest.
+    '''
+
+    def __init__(self, delta_expire=DELTA_EXPIRE):
+        self.delta_expire = delta_expire
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def _get_id(self, key):
+        return '%s:%s' % (key[0], key[1])
+
+    def _get_digest(self, key):
+        msg = '\0'.join([unicode(k).encode('utf-8') for k in key])
+        return hmac.new(get_secret(), msg, sha256).hexdigest()
+
+    def _remove_cookie_file(self, cookie_file):
+        if cookie_file and os.path.exists(cookie_file):
+            try:
+                os.remove(cookie_file)
+            except OSError, e:
+                logger.error('failed to remove %s: %s', cookie_file, str(e))
+
+    def get(self, key, create, cookie_file=None):
+        '''Get the client for the key or create it
+        using the create callable.
+
+        :param create: callable returning an authenticated client
+            or None if the authentication failed
+        :param cookie_file: cookie file of the client, reused while
+            the session record is valid and reset otherwise
+        '''
+        with self.lock:
+            now = datetime.utcnow()
+            session = self.sessions.get(key)
+            if session and session['created'] > now - self.delta_expire:
+                return session['client']
+
+            id = self._get_id(key)
+            digest = self._get_digest(key)
+            doc = Session.find_one({'_id': id})
+            valid = doc and doc['created'] > now - self.delta_expire \
+                    and doc.get('digest') == digest
+            if not valid:
+                self._remove_cookie_file(cookie_file)
+
+            client = create()
+            if client is None:
+                self.sessions.pop(key, None)
+                Session.remove({'_id': id}, safe=True)
+                return
+            if valid:
+                created = doc['created']
+            else:
+                created = now
+                Session.save({
+                        '_id': id,
+                        'name': key[0],
+                        'digest': digest,
+                        'cookie_file': cookie_file,
+                        'created': created,
+                        }, safe=True)
+                logger.debug('created %s session', key[0])
+            self.sessions[key] = {'client': client, 'created': created}
+            return client
+
+    def expire(self, key):
+        '''Expire the session for every process, so that
+        the next client logs in again.
+        '''
+        with self.lock:
+            self.sessions.pop(key, None)
+            id = self._get_id(key)
+            doc = Session.find_one({'_id': id})
+            if doc:
+                self._remove_cookie_file(doc.get('cookie_file'))
+                Session.remove({'_id': id}, safe=True)
+
+
+sessions = SessionPool()
+
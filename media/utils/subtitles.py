@@ -0,0 +1,38 @@
+from datetime import timedelta
+
+from mediacore.model.settings import Settings
+
+
+DELTA_UPDATE_DEF = [    # delta created, delta updated
+    (timedelta(days=365), timedelta(days=30)),
+    (timedelta(days=90), timedelta(days=15)),
+    (timedelta(days=30), timedelta(days=7)),
+    (timedelta(days=10), timedelta(days=2)),
+    (timedelta(days=3), timedelta(hours=12)),
+    (timedelta(days=0), timedelta(hours=6)),
+    ]
+
+
+def get_root_path():
+    return Settings.get_settings('paths')['media']['video'].rstrip('/') + '/'
+
+def get_next_check(media):
+    '''Get the date from which the media subtitles should be updated,
+    according to DELTA_UPDATE_DEF.
+    '''
+    if not media['info'].get('name'):
+        return
+    if not media.get('updated_subs'):
+        return media['created']
+    return min([max(media['created'] + d_created, media['updated_subs'] + d_updated)
+            for d_created, d_updated in DELTA_UPDATE_DEF])
+
+def get_subs_info(media, root_path):
+    '''Get the indexed fields used to find the media to process.
+    '''
+    files = media.get('files') or []
+    return {
+        'has_video_under_root': media.get('type') == 'video'
+                and bool([f for f in files if f.startswith(root_path)]),
+        'next_subs_check': get_next_check(media),
+        }
@@ -0,0 +1,66 @@
+import os.path
+from urlparse import urlparse, parse_qs
+
+
+EXTRA_FIELDS = ('date', 'rating', 'classification', 'genre', 'country',
+    'network', 'next_episode', 'director', 'stars', 'airs',
+    'runtime', 'title', 'url')
+SUMMARY_FIELDS = ['category', 'info', 'extra', 'files']
+
+
+def _get_extra(extra):
+    res = {}
+    for section, info in extra.items():
+        if not info:
+            continue
+        res.setdefault(section, {})
+        for key in EXTRA_FIELDS:
+            if key in info:
+                res[section][key] = info[key]
+    return res
+
+def _get_thumbnail_url(extra, category):
+    if category == 'music':
+        for section in ('sputnikmusic', 'lastfm'):
+            url = extra.get(section, {}).get('url_thumbnail')
+            if url:
+                return url
+
+    elif category in ('movies', 'tv', 'anime'):
+        for section in ('rottentomatoes', 'tvrage'):
+            url = extra.get(section, {}).get('url_thumbnail')
+            if url:
+                return url
+
+    return extra.get('youtube', {}).get('urls_thumbnails', [None])[0]
+
+def _get_video_id(extra):
+    url = extra.get('youtube', {}).get('url_watch')
+    if url:
+        qs = parse_qs(urlparse(url).query)
+        return qs['v'][0]
+
+def get_summary(obj):
+    '''Get the fields of the object rendered by the lists.
+    '''
+    if 'info' in obj:
+        category = obj['info'].get('subtype')
+    else:
+        category = obj.get('category')
+    extra = obj.get('extra') or {}
+    res = {
+        'extra': _get_extra(extra),
+        'url_thumbnail': _get_thumbnail_url(extra, category),
+        'video_id': _get_video_id(extra),
+        }
+    if 'files' in obj:
+        paths = [os.path.dirname(f) for f in obj['files']]
+        res['paths'] = sorted(list(set(paths)))
+    return res
+
+def update_summary(model, spec):
+    '''Update the summary of the objects matching the spec.
+    '''
+    for obj in model.find(spec, fields=SUMMARY_FIELDS):
+        model.update({'_id': obj['_id']},
+                {'$set': {'summary': get_summary(obj)}}, safe=True)
@@ -1,8 +1,10 @@
 from systools.system import webapp
 
 from media.apps import app
+from media.apps.api import ensure_indexes
 from media import settings
 
 
 def run():
+    ensure_indexes()
     webapp.run(app, host='0.0.0.0', port=settings.API_PORT)
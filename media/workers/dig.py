@@ -13,7 +13,10 @@ from mediacore.model.settings import Settings
 from mediacore.web.google import Google
 from mediacore.web.info import similar_movies, similar_tv, similar_music
 
-from media import settings, get_factory
+from media import settings
+from media.dispatch import add_job, get_free_slots
+from media.model.version import Version
+from media.utils.search import add_search_tokens
 
 
 WORKERS_LIMIT = 5
@@ -86,6 +89,8 @@ def add_search(**search):
     #     search['safe'] = False
     search['safe'] = False
     if not _media_exists(**search) and Search.add(**search):
+        add_search_tokens(Search, {'name': search['name']})
+        Version.bump('search', 'search_keys')
         logger.info('added search %s', search)
         return True
 
@@ -96,9 +101,13 @@ def process_similar(similar_id):
         Similar(search).process()
         search['processed'] = datetime.utcnow()
         SimilarSearch.save(search, safe=True)
+        Version.bump('similar')
 
 def process_similars():
-    count = 0
+    target = '%s.workers.dig.process_similar' % settings.PACKAGE_NAME
+    count = get_free_slots(target, WORKERS_LIMIT)
+    if not count:
+        return
 
     for search in SimilarSearch.find(sort=[('processed', ASCENDING)]):
         processed = search.get('processed')
@@ -106,13 +115,10 @@ def process_similars():
         if processed and processed > datetime.utcnow() - delta:
             continue
 
-        target = '%s.workers.dig.process_similar' % settings.PACKAGE_NAME
-        get_factory().add(target=target,
-                args=(search['_id'],), timeout=TIMEOUT_SEEK)
-
-        count += 1
-        if count == WORKERS_LIMIT:
-            break
+        if add_job(target, args=(search['_id'],), timeout=TIMEOUT_SEEK):
+            count -= 1
+            if not count:
+                break
 
 def process_releases():
     media_langs = Settings.get_settings('media_langs')
@@ -11,6 +11,9 @@ from mediacore.model.download import Download
 from mediacore.model.media import Media
 from mediacore.model.settings import Settings
 
+from media.model.version import Version
+from media.utils.search import add_search_tokens
+
 
 logger = logging.getLogger(__name__)
 
@@ -36,6 +39,8 @@ def run():
             res = move_file(download.file, dst)
             if res:
                 Media.add_file(res)
+                add_search_tokens(Media, {'files': res})
+                Version.bump('media')
                 Download.insert({
                         'name': download.filename,
                         'category': download.type,
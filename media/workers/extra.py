@@ -5,15 +5,23 @@ from pymongo import DESCENDING
 
 from systools.system import loop, timer
 
+from mediacore.model.media import Media
 from mediacore.model.settings import Settings
 from mediacore.web.google import Google
 from mediacore.web.info import search_extra
 from mediacore.utils.filter import validate_extra
 
-from media import settings, get_factory
+from media import settings
+from media.dispatch import add_job, get_free_slots
+from media.model.version import Version
+from media.utils.genres import get_genres
+from media.utils.search import update_search_tokens
+from media.utils.summary import update_summary
 
 
 WORKERS_LIMIT = 10
+GENRES_LIMIT = 500
+TOKENS_LIMIT = 500
 TIMEOUT_UPDATE = 600    # seconds
 DELTA_UPDATE_DEF = [    # delta created, delta updated
     (timedelta(days=365), timedelta(days=60)),
@@ -85,6 +93,8 @@ def update_obj_extra(objtype, objmodel, objid):
     if extra:
         doc['extra'] = extra
         doc['rating'] = _get_rating(extra, category)
+        if objtype == 'media':
+            doc['genres'] = get_genres(extra, category)
         if category == 'tv':
             if objtype == 'media':
                 spec = {'info.name': obj['info']['name']}
@@ -95,12 +105,18 @@ def update_obj_extra(objtype, objmodel, objid):
     doc['valid'] = validate_extra(extra or {}, media_filters)
 
     model.update(spec, {'$set': doc}, multi=True, safe=True)
+    update_search_tokens(model, spec)
+    update_summary(model, spec)
+    Version.bump(objtype)
 
     name = model.get_query(obj) if objtype == 'search' else obj['name']
     logger.info('updated %s %s "%s"', category, objtype, name)
 
 def update_extra(objtype, objmodel):
-    count = 0
+    target = '%s.workers.extra.update_obj_extra' % settings.PACKAGE_NAME
+    count = get_free_slots(target, WORKERS_LIMIT)
+    if not count:
+        return
 
     sort = [('date', DESCENDING)] if objtype == 'release' else [('created', DESCENDING)]
     model = get_model(objtype, objmodel)
@@ -115,21 +131,52 @@ def update_extra(objtype, objmodel):
         if not validate_object(obj['created'], obj.get('updated')):
             continue
 
-        target = '%s.workers.extra.update_obj_extra' % settings.PACKAGE_NAME
-        get_factory().add(target=target,
-                args=(objtype, objmodel, obj['_id']), timeout=TIMEOUT_UPDATE)
-
-        count += 1
-        if count == WORKERS_LIMIT:
-            break
+        if add_job(target, args=(objtype, objmodel, obj['_id']),
+                timeout=TIMEOUT_UPDATE):
+            count -= 1
+            if not count:
+                break
+
+def update_genres():
+    '''Set the genre tags of the media updated before they were stored.
+    '''
+    for media in Media.find({
+            'extra': {'$exists': True},
+            'genres': {'$exists': False},
+            }, fields=['extra', 'info.subtype'], limit=GENRES_LIMIT):
+        genres = get_genres(media['extra'], media['info'].get('subtype'))
+        Media.update({'_id': media['_id']},
+                {'$set': {'genres': genres}}, safe=True)
+
+def update_tokens(objtype, objmodel):
+    '''Set the search tokens and summary of the objects
+    updated before they were stored.
+    '''
+    model = get_model(objtype, objmodel)
+    if not model:
+        return
+    model.ensure_index('search_tokens')
+    for field, callback in [
+            ('search_tokens', update_search_tokens),
+            ('summary', update_summary),
+            ]:
+        ids = [r['_id'] for r in model.find(
+                {field: {'$exists': False}},
+                fields=['_id'], limit=TOKENS_LIMIT)]
+        if ids:
+            callback(model, {'_id': {'$in': ids}})
+            Version.bump(objtype)
 
 @loop(minutes=2)
 def run():
-    if Google().accessible:
-        for type, model in [
-                ('media', 'Media'),
-                ('release', 'Release'),
-                ('search', 'Search'),
-                ('similar', 'SimilarSearch'),
-                ]:
+    update_genres()
+
+    for type, model in [
+            ('media', 'Media'),
+            ('release', 'Release'),
+            ('search', 'Search'),
+            ('similar', 'SimilarSearch'),
+            ]:
+        update_tokens(type, model)
+        if Google().accessible:
             update_extra(type, model)
@@ -9,10 +9,17 @@ from systools.system import loop, timer
 from filetools.media import iter_files
 
 from mediacore.model.media import Media
+from mediacore.model.subtitles import Subtitles
 from mediacore.model.work import Work
 from mediacore.model.settings import Settings
 
-from media import settings, get_factory
+from media import settings
+from media.dispatch import add_job
+from media.model.dirsize import DirSize
+from media.model.version import Version
+from media.utils.search import get_search_tokens, add_search_tokens
+from media.utils.summary import get_summary
+from media.utils.subtitles import get_root_path, get_subs_info
 
 
 NAME = os.path.splitext(os.path.basename(__file__))[0]
@@ -42,6 +49,7 @@ def update_path():
         if not re_excl.search(file):
             Media.add_file(file)
         time.sleep(.05)
+    add_search_tokens(Media, {})
 
     for media in Media.find({'files': {'$exists': True}}, timeout=False):
         files_orig = media['files'][:]
@@ -49,11 +57,20 @@ def update_path():
             if not os.path.exists(file) or re_excl.search(file):
                 media['files'].remove(file)
 
+        files_removed = list(set(files_orig) - set(media['files']))
+        if files_removed:
+            Subtitles.remove({'file': {'$in': files_removed}}, safe=True)
+
         if not media['files'] and not media.get('urls'):
             Media.remove({'_id': media['_id']}, safe=True)
         elif media['files'] != files_orig:
+            media['summary'] = get_summary(media)
             Media.save(media, safe=True)
 
+    # Nested files changes do not update the directories mtime
+    DirSize.remove(safe=True)
+    Version.bump('media')
+
     Work.set_info(NAME, 'updated', datetime.utcnow())
 
 def get_mtime(files):
@@ -70,17 +87,27 @@ def get_mtime(files):
 
 @timer()
 def update_media():
+    root_path = get_root_path()
+    updated = False
     for res in Media.find({'files': {'$exists': True}}, timeout=False):
+        doc = get_subs_info(res, root_path)
         mtime = get_mtime(res['files'])
         if mtime:
-            Media.update({'_id': res['_id']},
-                    {'$set': {'date': mtime}}, safe=True)
+            doc['date'] = mtime
+        doc['search_tokens'] = get_search_tokens(res)
+        doc['summary'] = get_summary(res)
+        if all([res.get(k) == v for k, v in doc.items()]):
+            continue
+        Media.update({'_id': res['_id']}, {'$set': doc}, safe=True)
+        updated = True
+    if updated:
+        Version.bump('media')
 
 @loop(minutes=15)
 def run():
     if validate_update_path():
         target = '%s.workers.file.update_path' % settings.PACKAGE_NAME
-        get_factory().add(target=target, timeout=TIMEOUT_UPDATE)
+        add_job(target, timeout=TIMEOUT_UPDATE)
 
     target = '%s.workers.file.update_media' % settings.PACKAGE_NAME
-    get_factory().add(target=target, timeout=TIMEOUT_UPDATE)
+    add_job(target, timeout=TIMEOUT_UPDATE)
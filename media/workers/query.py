@@ -1,10 +1,13 @@
+import os
 import httplib2
 import imaplib
+import socket
 from email import message_from_string
 import time
 from calendar import timegm
+from datetime import datetime, timedelta
 from urlparse import urlparse
-import re
+from multiprocessing.pool import ThreadPool
 import logging
 
 import dateutil.parser
@@ -15,7 +18,7 @@ logging.getLogger('apiclient').setLevel(logging.ERROR)
 logging.getLogger('oauth2client').setLevel(logging.ERROR)
 
 from apiclient import errors
-from apiclient.discovery import build
+from apiclient.discovery import build_from_document
 from apiclient.http import MediaInMemoryUpload
 from oauth2client.client import Credentials, AccessTokenRefreshError
 
@@ -25,27 +28,72 @@ from transfer import Transfer
 
 from mediacore.model.search import Search
 from mediacore.model.settings import Settings
+from mediacore.model.work import Work
 from mediacore.utils.query import get_searches, QueryError
 
+from media.model.version import Version
+from media.utils.search import add_search_tokens
 
+
+NAME = os.path.splitext(os.path.basename(__file__))[0]
 MODIFIED_DELTA = 30     # drive file modified delta in seconds
+QUERY_WORKERS = 4
+DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/drive/v2/rest'
+DISCOVERY_FILE = 'drive_v2_discovery.json'
+DELTA_DISCOVERY = timedelta(days=7)
 
 logger = logging.getLogger(__name__)
+_drive = {}
+_gmail = {}
 
 
 class DriveError(Exception): pass
+class DriveFileNotFound(DriveError): pass
 
 
 class DriveClient(object):
 
-    def __init__(self, credentials):
+    def __init__(self, credentials, discovery_file, discovery_url=DISCOVERY_URL):
         credentials_ = Credentials.new_from_json(credentials)
         http = httplib2.Http()
         http = credentials_.authorize(http)
-        self.service = build('drive', 'v2', http=http)
-
-    def get_file_by_id(self, file_id):
-        return self.service.files().get(fileId=file_id).execute()
+        document = self._get_discovery(http, discovery_file, discovery_url)
+        self.service = build_from_document(document, http=http)
+
+    def _get_discovery(self, http, file, url):
+        '''Get the drive API discovery document from the local cache,
+        downloading it if missing or obsolete.
+        '''
+        if os.path.exists(file):
+            modified = datetime.utcfromtimestamp(os.stat(file).st_mtime)
+            if modified > datetime.utcnow() - DELTA_DISCOVERY:
+                with open(file) as fd:
+                    return fd.read()
+
+        resp, content = http.request(url)
+        if resp.status != 200:
+            raise DriveError('failed to get discovery document: %s' % resp)
+        with open(file, 'wb') as fd:
+            fd.write(content)
+        return content
+
+    def get_file_by_id(self, file_id, etag=None):
+        '''Get the file metadata.
+
+        :param etag: etag of the last known version
+        :return: None if the file has not been modified since
+        '''
+        request = self.service.files().get(fileId=file_id)
+        if etag:
+            request.headers['If-None-Match'] = etag
+        try:
+            return request.execute()
+        except errors.HttpError, e:
+            if e.resp.status == 304:
+                return
+            if e.resp.status == 404:
+                raise DriveFileNotFound('file %s not found' % file_id)
+            raise
 
     def get_file_by_title(self, title):
         res = self.service.files().list(q="title='%s'" % title).execute()
@@ -61,11 +109,18 @@ class DriveClient(object):
         return content.decode('utf-8-sig')
 
     def set_file_content(self, file, body, mime_type='text/html'):
+        '''Update the file content, unless the file has been
+        modified since its metadata were fetched.
+        '''
         media = MediaInMemoryUpload(body, mimetype=mime_type)
+        request = self.service.files().update(fileId=file['id'],
+                newRevision=True, media_body=media)
+        request.headers['If-Match'] = file['etag']
         try:
-            return self.service.files().update(fileId=file['id'],
-                    newRevision=True, media_body=media).execute()
+            return request.execute()
         except errors.HttpError, e:
+            if e.resp.status == 412:
+                raise DriveError('file %s modified during processing' % file['id'])
             raise DriveError('google api error: %s' % str(e))
 
 
@@ -82,33 +137,17 @@ class FileLine(object):
             res += links[0].get('href') if links else el.text
         return res
 
-    def _get_element(self):
-        return html.tostring(self.element)
-
-    def _get_sub_pattern(self):
-        return re.sub(r'class\\=\\"[^\"]*\\"', r'class="([^\"]*)"',
-                re.escape(self._get_element()))
-
-    def _replace(self, matchobj):
-        self.group_num += 1
-        return 'class="\\%d"' % self.group_num
-
-    def _get_sub_repl(self):
-        self.group_num = 0
-        return re.sub(r'class="([^\"]*)"', self._replace, self._get_element())
-
     def get_query(self):
         if self.spans:
             begin = self.spans[0].text
             if begin and begin.startswith('?'):
                 return self._get_line().lstrip('?').strip()
 
-    def get_patterns(self, has_results=True):
-        pattern = self._get_sub_pattern()
+    def set_processed(self, has_results=True):
+        '''Replace the query mark of the line in place.
+        '''
         prefix = '' if has_results else '!'
         self.spans[0].text = prefix + self.spans[0].text.lstrip('?')
-        repl = self._get_sub_repl()
-        return pattern, repl
 
 
 class GmailClient(object):
@@ -116,7 +155,10 @@ class GmailClient(object):
     def __init__(self, host, port, username, password):
         self.client = imaplib.IMAP4_SSL(host, port)
         self.client.login(username, password)
-        self.client.select()
+        typ, data = self.client.select()
+        self.count = int(data[0])
+        self.checked = False
+        self.pending = False    # messages left to process again
 
     def close(self):
         try:
@@ -125,81 +167,180 @@ class GmailClient(object):
             pass
         self.client.logout()
 
-    def extract_body(self, payload):
-        if not isinstance(payload, basestring):
-            return '\n'.join([self.extract_body(p.get_payload()) for p in payload])
-        return payload
+    def has_new_messages(self):
+        '''Check if messages have been added since the last check,
+        using the EXISTS responses to a NOOP, or if messages
+        failed to be processed.
+        '''
+        self.client.noop()
+        typ, data = self.client.response('EXISTS')
+        count = int(data[-1]) if data and data[-1] is not None else self.count
+        res = count > self.count or not self.checked or self.pending
+        self.count = count
+        self.checked = True
+        return res
 
     def iter_messages(self, from_email):
         args = (None,)
         args += ('FROM', from_email) if from_email else ('UNSEEN',)
         typ, data = self.client.search(*args)
-        for num in data[0].split():
-            typ, msg_data = self.client.fetch(num, '(RFC822)')
-            for response_part in msg_data:
-                if isinstance(response_part, tuple):
-                    msg = message_from_string(response_part[1])
-                    to_email = msg.get('To')
-                    if to_email and from_email not in to_email:
-                        continue
-                    payload = msg.get_payload()
-                    yield {
-                        'num': num,
-                        'subject': msg['subject'],
-                        'body': self.extract_body(payload),
-                        }
-
-    def delete(self, num):
-        typ, response = self.client.store(num, '+FLAGS', r'(\Deleted)')
+        nums = data[0].split()
+        if not nums:
+            return
+
+        typ, msg_data = self.client.fetch(','.join(nums),
+                '(BODY.PEEK[HEADER.FIELDS (SUBJECT TO)])')
+        for response_part in msg_data:
+            if isinstance(response_part, tuple):
+                num = response_part[0].split()[0]
+                msg = message_from_string(response_part[1])
+                to_email = msg.get('To')
+                if to_email and from_email not in to_email:
+                    continue
+                yield {
+                    'num': num,
+                    'subject': msg['subject'],
+                    }
+
+    def delete(self, nums):
+        if not nums:
+            return
+        self.client.store(','.join(nums), '+FLAGS', r'(\Deleted)')
+        self.client.expunge()
+        self.count -= len(nums)
 
 
+def get_drive_client(credentials):
+    '''Get the process drive client, created again only
+    when the credentials change.
+    '''
+    if _drive.get('credentials') != credentials:
+        path_tmp = Settings.get_settings('paths')['tmp']
+        _drive['client'] = DriveClient(credentials,
+                discovery_file=os.path.join(path_tmp, DISCOVERY_FILE))
+        _drive['credentials'] = credentials
+    return _drive['client']
+
+def get_modified_file(drive, title):
+    '''Get the drive file if modified since it was last processed,
+    with a conditional request when the file id is known.
+    '''
+    info = Work.get_info(NAME, 'drive_file') or {}
+    if info.get('title') == title and info.get('id'):
+        try:
+            return drive.get_file_by_id(info['id'], etag=info.get('etag'))
+        except DriveFileNotFound:
+            pass
+    return drive.get_file_by_title(title)
+
+def set_processed_file(file_, title):
+    Work.set_info(NAME, 'drive_file', {
+            'title': title,
+            'id': file_['id'],
+            'etag': file_['etag'],
+            })
+
+def get_gmail_client(email_):
+    '''Get the process IMAP client, connected again only
+    when the email settings change.
+    '''
+    key = tuple([email_[k] for k in ('host', 'port', 'username', 'password')])
+    if _gmail.get('key') != key:
+        if _gmail.get('client'):
+            _gmail['client'].close()
+        _gmail['client'] = GmailClient(*key)
+        _gmail['key'] = key
+    return _gmail['client']
+
 def check_modified(date, delta):
     modified = dateutil.parser.parse(date)
     elapsed = int(time.time()) - timegm(modified.utctimetuple())
     return elapsed > delta
 
-def process_query(query):
-    '''Process the query and return the number of results.
+def _add_transfer(url):
+    # The queries of a file update failing on its precondition
+    # are processed again on the next run
+    if Transfer.find_one({'src': url}):
+        return 1
+    dst = Settings.get_settings('paths')['finished_download']
+    try:
+        Transfer.add(url, dst)
+    except Exception, e:
+        logger.error('failed to create transfer for %s: %s', url, str(e))
+        return -1
+    return 1
+
+def _get_searches(query):
+    try:
+        return get_searches(query)
+    except QueryError, e:
+        logger.info(str(e))
+
+def process_queries(queries):
+    '''Process the queries and return a dict with the number
+    of results per query, -1 if the query failed.
+
+    Identical queries are processed once and the searches
+    are resolved concurrently.
     '''
-    if urlparse(query).scheme:
-        dst = Settings.get_settings('paths')['finished_download']
-        try:
-            Transfer.add(query, dst)
-        except Exception, e:
-            logger.error('failed to create transfer for %s: %s', query, str(e))
-            return -1
-        count = 1
-    else:
-        try:
-            searches = get_searches(query)
-        except QueryError, e:
-            logger.info(str(e))
-            return -1
-        count = len(searches)
+    res = {}
+    names = []
+    for query in queries:
+        if query in res or query in names:
+            continue
+        if urlparse(query).scheme:
+            res[query] = _add_transfer(query)
+        else:
+            names.append(query)
+    if not names:
+        return res
+
+    pool = ThreadPool(min(QUERY_WORKERS, len(names)))
+    try:
+        searches_list = pool.map(_get_searches, names)
+    finally:
+        pool.close()
+
+    added = []
+    for query, searches in zip(names, searches_list):
+        if searches is None:
+            res[query] = -1
+            continue
+        res[query] = len(searches)
         if not searches:
             logger.info('no result for query "%s', query)
-        else:
-            for search in searches:
-                if Search.add(**search):
-                    logger.info('created search %s', search)
+        for search in searches:
+            if search in added:
+                continue
+            added.append(search)
+            if Search.add(**search):
+                add_search_tokens(Search, {'name': search['name']})
+                Version.bump('search', 'search_keys')
+                logger.info('created search %s', search)
 
-    return count
+    return res
 
 def process_file_queries(body):
-    '''Process the file queries and return a list of patterns and replacement strings.
+    '''Process the file queries and return the updated body
+    or None if no query has been processed.
     '''
-    res = []
+    processed = False
+    lines = []
     tree = html.fromstring(body)
     for element in tree.cssselect('body p'):
         line = FileLine(element)
         query = line.get_query()
-        if query is None:
-            continue
-        count = process_query(query)
-        if count != -1:
-            res.append(line.get_patterns(count > 0))
+        if query is not None:
+            lines.append((line, query))
 
-    return res
+    counts = process_queries([q for l, q in lines])
+    for line, query in lines:
+        if counts[query] != -1:
+            line.set_processed(counts[query] > 0)
+            processed = True
+
+    if processed:
+        return html.tostring(tree.getroottree(), encoding=unicode)
 
 @timeout(minutes=10)
 @timer(60)
@@ -211,23 +352,22 @@ def process_drive():
     if not credentials:
         return
 
-    drive = DriveClient(credentials)
     try:
-        file_ = drive.get_file_by_title(file_title)
+        drive = get_drive_client(credentials)
+        file_ = get_modified_file(drive, file_title)
         if not file_:
             return
         if not check_modified(file_['modifiedDate'], delta=MODIFIED_DELTA):
             return
 
         body = drive.get_file_content(file_, mime_type='text/html')
-        patterns = process_file_queries(body)
-        if patterns:
-            body = drive.get_file_content(file_, mime_type='text/html')
-            for pattern, repl in patterns:
-                body = re.sub(pattern, repl, body, 1)
-            drive.set_file_content(file_, body=body, mime_type='text/html')
+        body = process_file_queries(body)
+        if body:
+            file_ = drive.set_file_content(file_, body=body, mime_type='text/html')
+        set_processed_file(file_, file_title)
 
     except AccessTokenRefreshError:
+        _drive.clear()
         logger.error('revoked or expired google API credentials %s', credentials)
     except (DriveError, errors.HttpError), e:
         logger.error('unexpected error: %s', str(e))
@@ -243,14 +383,18 @@ def process_email():
             or not email_.get('from_email'):
         return
 
-    client = GmailClient(host=email_['host'],
-            port=email_['port'],
-            username=email_['username'],
-            password=email_['password'])
-    for message in client.iter_messages(email_['from_email']):
-        if process_query(message['subject']) != -1:
-            client.delete(message['num'])
-    client.close()
+    try:
+        client = get_gmail_client(email_)
+        if not client.has_new_messages():
+            return
+        messages = list(client.iter_messages(email_['from_email']))
+        counts = process_queries([m['subject'] for m in messages])
+        nums = [m['num'] for m in messages if counts[m['subject']] != -1]
+        client.delete(nums)
+        client.pending = len(nums) < len(messages)
+    except (imaplib.IMAP4.error, socket.error), e:
+        _gmail.clear()
+        logger.error('imap error: %s', str(e))
 
 @loop(60)
 def run():
@@ -16,7 +16,10 @@ from mediacore.web.vcdquality import Vcdquality
 from mediacore.web.tvrage import Tvrage
 from mediacore.web.sputnikmusic import Sputnikmusic
 
-from media import settings, get_factory
+from media import settings
+from media.dispatch import add_job
+from media.model.version import Version
+from media.utils.search import add_search_tokens
 
 
 NAME = os.path.splitext(os.path.basename(__file__))[0]
@@ -171,18 +174,22 @@ def _import_sputnikmusic():
 def import_releases(type):
     res = Work.get_info(NAME, type)
     if not res or res < datetime.utcnow() - DELTA_IMPORT:
+        started = datetime.utcnow()
         globals().get('_import_%s' % type)()
         Work.set_info(NAME, type, datetime.utcnow())
+        if Release.find_one({'created': {'$gte': started}}):
+            add_search_tokens(Release, {})
+            Version.bump('release')
 
 @loop(minutes=5)
 def run():
     if Google().accessible:
-        factory = get_factory()
-
         for type in ('imdb', 'metacritic', 'rottentomatoes', 'vcdquality',
                 'tvrage', 'sputnikmusic'):
             target = '%s.workers.release.import_releases' % settings.PACKAGE_NAME
-            factory.add(target=target, args=(type,), timeout=TIMEOUT_IMPORT)
+            add_job(target, args=(type,), timeout=TIMEOUT_IMPORT)
 
-        Release.remove({'date': {'$lt': datetime.utcnow() - DELTA_RELEASE}},
+        res = Release.remove({'date': {'$lt': datetime.utcnow() - DELTA_RELEASE}},
                 safe=True)
+        if res and res.get('n'):
+            Version.bump('release')
@@ -15,11 +15,15 @@ from mediacore.model.search import Search as MSearch
 from mediacore.model.media import Media
 from mediacore.model.result import Result
 from mediacore.model.settings import Settings
-from mediacore.web.search import results
 from mediacore.web.google import Google
 from mediacore.web.netflix import Netflix, NETFLIX_CATEGORIES
 
-from media import settings, get_factory
+from media import settings
+from media.dispatch import add_job, get_free_slots
+from media.model.version import Version
+from media.utils.results import results, PAGE_SIZE
+from media.utils.search import add_search_tokens
+from media.utils.session import sessions
 
 
 WORKERS_LIMIT = 5
@@ -29,6 +33,14 @@ DELTA_SEARCH = {
     'once': timedelta(hours=4),
     'ever': timedelta(hours=6),
     }
+DELTA_SEARCH_FACTOR_MAX = 6    # DELTA_SEARCH multiplier for idle searches
+DELTA_SCORE_IDLE = timedelta(days=30)   # idle delay halving the score
+CATEGORY_SCORES = {
+    'tv': 1,
+    'anime': 1,
+    'movies': .8,
+    'music': .6,
+    }
 DELTA_FILE_SEARCH = timedelta(hours=1)
 DELTA_URL_SEARCH = timedelta(hours=24)
 DELTA_RESULT = {
@@ -41,6 +53,11 @@ DELTA_IDLE_SEARCH = timedelta(days=2)
 DELTA_OBSOLETE = timedelta(days=90)
 DELTA_NEXT_SEASON = timedelta(days=60)
 PAGES_MAX = 20
+TRANSFERS_MAX = 100
+NETFLIX_COOKIE_FILE = 'netflix_cookies.txt'
+SESSION_FIELDS = ('first_search', 'last_search', 'last_result',
+    'last_download', 'next_search', 'score', 'sort_results', 'pages_max',
+    'nb_results', 'nb_pending', 'nb_downloads', 'nb_errors')
 SEARCH_LIMIT = 10
 NB_SEEDS_MIN = {
     'once': 0,
@@ -57,6 +74,7 @@ class Search(dotdict):
         super(Search, self).__init__(doc)
         self.langs = self.get('langs') or []
         self.transfers = self.get('transfers', [])
+        self.new_transfers = []
 
         session = self.get('session', {})
         if session.get('nb_downloads') == 0 \
@@ -75,6 +93,8 @@ class Search(dotdict):
             'last_download': session.get('last_download'),
             'last_file_search': session.get('last_file_search'),
             'last_url_search': session.get('last_url_search'),
+            'next_search': session.get('next_search'),
+            'score': session.get('score'),
             'nb_processed': session.get('nb_processed', 0),
             'sort_results': sort_results,
             'pages_max': pages_max,
@@ -92,6 +112,8 @@ class Search(dotdict):
         '''
         search = MSearch.get_next(self, mode=mode)
         if search and MSearch.add(**search):
+            add_search_tokens(MSearch, {'name': search['name']})
+            Version.bump('search_keys')
             logger.info('added search %s', search)
 
     def _search_file(self):
@@ -114,8 +136,10 @@ class Search(dotdict):
             if src:
                 Media.update({'_id': {'$in': [m['_id'] for m in media_]}},
                         {'$set': {'src': src}}, safe=True)
+                Version.bump('media')
 
             MSearch.remove({'_id': self._id}, safe=True)
+            Version.bump('search_keys')
             logger.info('removed %s search "%s": found files %s', self.category, self._get_query(), files)
             return True
 
@@ -129,6 +153,7 @@ class Search(dotdict):
         date = self.session['last_result'] or self.session['first_search']
         if date and date < datetime.utcnow() - DELTA_OBSOLETE:
             MSearch.remove({'_id': self._id}, safe=True)
+            Version.bump('search_keys')
             logger.info('removed search "%s" (no result for %d days)', self._get_query(), DELTA_OBSOLETE.days)
             return True
 
@@ -138,6 +163,20 @@ class Search(dotdict):
             return False
         return True
 
+    def _get_score(self):
+        '''Get the search score, between 0 and 1, according to
+        the time elapsed since the last result and the category.
+        '''
+        now = datetime.utcnow()
+        date = self.session['last_result'] or self.session['first_search'] or now
+        idle = (now - date).total_seconds() / DELTA_SCORE_IDLE.total_seconds()
+        return CATEGORY_SCORES.get(self.category, 1) / (1 + idle)
+
+    def _get_next_search(self, score):
+        factor = 1 + (1 - score) * (DELTA_SEARCH_FACTOR_MAX - 1)
+        delta = DELTA_SEARCH[self.mode].total_seconds() * factor
+        return datetime.utcnow() + timedelta(seconds=delta)
+
     def _check_episode(self):
         if self.get('season') and self.get('episode') and self.episode > 2 \
                 and self.session['first_search'] \
@@ -185,24 +224,27 @@ class Search(dotdict):
         netflix_ = Settings.get_settings('netflix')
         if not netflix_['username'] or not netflix_['password']:
             return False
-        netflix = get_netflix_object(netflix_['username'], netflix_['password'])
+        username, password = netflix_['username'], netflix_['password']
+        netflix = get_netflix_object(username, password)
         if not netflix:
             return False
 
-        res = netflix.get_info(self.name, self.category)
-        if res:
-            Media.add_url(url=res['url'], name=res['title'],
-                    category=self.category)
-            logger.info('found "%s" on netflix (%s)', res['title'], res['url'])
-            if self.category == 'movies':
-                MSearch.remove({'_id': self._id}, safe=True)
-                logger.info('removed %s search "%s": found url %s', self.category, self.name, res['url'])
-                return True
-
-        MSearch.update({'_id': self._id},
-                {'$set': {'session.last_url_search': datetime.utcnow()}},
-                safe=True)
-        return False
+        # Process the searches with the same name at once
+        searches = list(MSearch.find({
+                'name': self.name,
+                'category': {'$in': NETFLIX_CATEGORIES},
+                '$or': [
+                    {'session.last_url_search': None},
+                    {'session.last_url_search': {'$lt': datetime.utcnow() - DELTA_URL_SEARCH}},
+                    ],
+                }))
+        if self._id not in [s['_id'] for s in searches]:
+            searches.append(self)
+        removed = search_netflix(netflix, self.name, searches, self._id)
+        if removed is None:
+            sessions.expire(_get_netflix_key(username, password))
+            return False
+        return removed
 
     def process(self):
         query = self._get_query()
@@ -212,7 +254,9 @@ class Search(dotdict):
 
         self._search_url()
 
-        for result in results(query,
+        # Only the ever mode consumes the results past the first download
+        window = PAGE_SIZE if self.mode == 'ever' else 0
+        for result in results(query, window=window,
                 category=self.category,
                 sort=self.session['sort_results'],
                 pages_max=self.session['pages_max'],
@@ -245,6 +289,7 @@ class Search(dotdict):
 
             transfer_id = Transfer.add(result.url, dst, type=result.type)
             self.transfers.insert(0, transfer_id)
+            self.new_transfers.insert(0, transfer_id)
 
             self.session['nb_downloads'] += 1
             logger.info('found "%s" on %s (%s)', result.title, result.plugin, result.url)
@@ -252,8 +297,22 @@ class Search(dotdict):
             if self.mode != 'ever':
                 break
 
+    def _push_transfers(self):
+        # $position requires MongoDB 2.6
+        return {'transfers': {
+                '$each': self.new_transfers,
+                '$position': 0,
+                '$slice': TRANSFERS_MAX,
+                }}
+
     def save(self):
+        '''Update the session fields and new transfers of the search.
+
+        The update is skipped if the search has been modified since
+        it was loaded (e.g.: session reset by the API).
+        '''
         now = datetime.utcnow()
+        inc = {'version': 1}
 
         if not self.session['first_search']:
             self.session['first_search'] = now
@@ -264,17 +323,85 @@ class Search(dotdict):
         if self.session['nb_errors'] <= 1:
             self.session['last_search'] = now
             self.session['nb_processed'] += 1
+            self.session['score'] = self._get_score()
+            self.session['next_search'] = self._get_next_search(
+                    self.session['score'])
+            inc['session.nb_processed'] = 1
+
+        doc = {
+            '$set': dict([('session.%s' % k, self.session[k]) for k in SESSION_FIELDS]),
+            '$inc': inc,
+            }
+        if self.new_transfers:
+            doc['$push'] = self._push_transfers()
 
-        MSearch.save(self, safe=True)
+        res = MSearch.update({'_id': self._id, 'version': self.get('version')},
+                doc, safe=True)
+        if res and not res.get('n'):
+            logger.info('skipped session update of search "%s": modified concurrently', self._get_query())
+            if self.new_transfers:
+                MSearch.update({'_id': self._id},
+                        {'$push': self._push_transfers()}, safe=True)
 
 
-def get_netflix_object(username, password):
-    path_tmp = Settings.get_settings('paths')['tmp']
-    res = Netflix(username, password,
-            cookie_file=os.path.join(path_tmp, 'netflix_cookies.txt'))
+def _get_netflix_key(username, password):
+    return 'netflix', username, password
+
+def _get_netflix(username, password, cookie_file):
+    res = Netflix(username, password, cookie_file=cookie_file)
     if res.logged:
         return res
 
+def get_netflix_object(username, password):
+    path_tmp = Settings.get_settings('paths')['tmp']
+    cookie_file = os.path.join(path_tmp, NETFLIX_COOKIE_FILE)
+    return sessions.get(_get_netflix_key(username, password),
+            lambda: _get_netflix(username, password, cookie_file),
+            cookie_file=cookie_file)
+
+def search_netflix(netflix, name, searches, search_id):
+    '''Search netflix urls for searches sharing the same name,
+    with a single lookup per category.
+
+    Only the search_id search is removed when its url is found,
+    the other searches being checked again on their own run.
+
+    :return: True if the search_id search has been removed,
+        None if the session is logged out
+    '''
+    infos = {}
+    removed = False
+    for search in searches:
+        category = search['category']
+        if category not in infos:
+            res = netflix.get_info(name, category)
+            if not netflix.logged:
+                logger.info('netflix session is logged out')
+                return
+            if res:
+                Media.add_url(url=res['url'], name=res['title'],
+                        category=category)
+                add_search_tokens(Media, {'urls': res['url']})
+                Version.bump('media')
+                logger.info('found "%s" on netflix (%s)', res['title'], res['url'])
+            infos[category] = res
+
+        res = infos[category]
+        if res and category == 'movies':
+            if search['_id'] != search_id:
+                continue
+            MSearch.remove({'_id': search['_id']}, safe=True)
+            Version.bump('search_keys')
+            logger.info('removed %s search "%s": found url %s', category, name, res['url'])
+            removed = True
+        else:
+            MSearch.update({'_id': search['_id']},
+                    {'$set': {'session.last_url_search': datetime.utcnow()}},
+                    safe=True)
+
+    Version.bump('search')
+    return removed
+
 @timer(300)
 def process_search(search_id):
     search = MSearch.get(search_id)
@@ -282,23 +409,28 @@ def process_search(search_id):
         search = Search(search)
         search.process()
         search.save()
+        Version.bump('search')
 
 def process_searches():
-    count = 0
-
-    for search in MSearch.find(
-            sort=[('session.last_search', ASCENDING)]):
+    target = '%s.workers.search.process_search' % settings.PACKAGE_NAME
+    count = get_free_slots(target, WORKERS_LIMIT)
+    if not count:
+        return
+
+    MSearch.ensure_index([('session.next_search', ASCENDING)])
+    for search in MSearch.find({'$or': [
+            {'session.next_search': None},
+            {'session.next_search': {'$lt': datetime.utcnow()}},
+            ]},
+            sort=[('session.next_search', ASCENDING)]):
         search = Search(search)
         if not search.validate():
             continue
 
-        target = '%s.workers.search.process_search' % settings.PACKAGE_NAME
-        get_factory().add(target=target,
-                args=(search._id,), timeout=TIMEOUT_SEARCH)
-
-        count += 1
-        if count == WORKERS_LIMIT:
-            break
+        if add_job(target, args=(search._id,), timeout=TIMEOUT_SEARCH):
+            count -= 1
+            if not count:
+                break
 
 @loop(60)
 def run():
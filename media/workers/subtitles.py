@@ -1,8 +1,12 @@
 import os.path
 from datetime import datetime, timedelta
+import time
+import threading
+from Queue import Queue
 import logging
 
 from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError, OperationFailure
 
 from systools.system import loop, timer
 
@@ -12,27 +16,35 @@ from filetools.title import clean
 from mediacore.model.media import Media
 from mediacore.model.subtitles import Subtitles
 from mediacore.model.settings import Settings
+from mediacore.model.work import Work
 from mediacore.web import RateLimitReached
 from mediacore.web.google import Google
-from mediacore.web.opensubtitles import Opensubtitles
 from mediacore.web.subscene import Subscene
 
-from media import settings, get_factory
+from media import settings
+from media.dispatch import add_job, get_free_slots
+from media.model.quota import Quota
+from media.model.version import Version
+from media.utils.filehash import get_hash
+from media.utils.opensubtitles import Opensubtitles
+from media.utils.subtitles import get_root_path, get_subs_info
 
 
 NAME = os.path.splitext(os.path.basename(__file__))[0]
 WORKERS_LIMIT = 4
-DELTA_UPDATE_DEF = [    # delta created, delta updated
-    (timedelta(days=365), timedelta(days=30)),
-    (timedelta(days=90), timedelta(days=15)),
-    (timedelta(days=30), timedelta(days=7)),
-    (timedelta(days=10), timedelta(days=2)),
-    (timedelta(days=3), timedelta(hours=12)),
-    (timedelta(days=0), timedelta(hours=6)),
-    ]
 DELTA_OPENSUBTITLES_QUOTA = timedelta(hours=12)
+DELTA_QUOTA_DEF = timedelta(hours=1)
+PLUGINS_QUOTA = {  # calls, delta
+    'opensubtitles': (200, timedelta(days=1)),
+    }
 TIMEOUT_SEARCH = 1200   # seconds
+DELTA_CLEAN = timedelta(minutes=30)
+CLEAN_LIMIT = 500
 VIDEO_SIZE_MIN = 100    # MB
+PLUGINS_CONCURRENCY = {
+    'subscene': 2,
+    'opensubtitles': 2,
+    }
 LANGS_DEF = {
     'opensubtitles': {
         'en': 'eng',
@@ -47,18 +59,6 @@ LANGS_DEF = {
 logger = logging.getLogger(__name__)
 
 
-def validate_media(media):
-    if not media['info'].get('name'):
-        return
-    if not media.get('updated_subs'):
-        return True
-    now = datetime.utcnow()
-    delta_created = now - media['created']
-    delta_updated = now - media['updated_subs']
-    for d_created, d_updated in DELTA_UPDATE_DEF:
-        if delta_created > d_created and delta_updated > d_updated:
-            return True
-
 def validate_file(file, root_path):
     if not file.startswith(root_path):
         return
@@ -68,6 +68,197 @@ def validate_file(file, root_path):
         return
     return True
 
+def _get_plugin(name):
+    if name == 'subscene':
+        return Subscene()
+    elif name == 'opensubtitles':
+        return Opensubtitles(**Settings.get_settings('opensubtitles'))
+
+def _consume_quota(obj_name):
+    capacity, delta = PLUGINS_QUOTA.get(obj_name, (None, None))
+    return Quota.consume(obj_name, capacity, delta)
+
+def _block_plugin(obj_name):
+    delta = DELTA_OPENSUBTITLES_QUOTA if obj_name == 'opensubtitles' else DELTA_QUOTA_DEF
+    Quota.block(obj_name, delta)
+    logger.info('blocked %s for %s', obj_name, delta)
+
+def get_available_plugins():
+    '''Get the plugins which have not reached their quota.
+    '''
+    res = []
+    for obj_name in PLUGINS_CONCURRENCY:
+        capacity, delta = PLUGINS_QUOTA.get(obj_name, (None, None))
+        if Quota.available(obj_name, capacity, delta):
+            res.append(obj_name)
+    return res
+
+
+class SubtitlesSearch(object):
+    '''Query the subtitles plugins concurrently and download
+    the results while the searches are still running.
+
+    Plugins supporting it are first queried by file hash, and
+    by name for the files without results. Name queries are
+    issued once per lang for all the files.
+    '''
+
+    def __init__(self, files, temp_dir):
+        self.files = files
+        self.temp_dir = temp_dir
+        self.stats = {}
+        self.exhausted = set()
+        self.matched = set()
+        self.lock = threading.Lock()
+
+    def _add_stat(self, obj_name, key, start):
+        with self.lock:
+            stat = self.stats.setdefault(obj_name,
+                    {'search': 0, 'download': 0, 'nb_downloads': 0})
+            stat[key] += time.time() - start
+            if key == 'download':
+                stat['nb_downloads'] += 1
+
+    def _consume(self, obj_name):
+        '''Take a quota token before a plugin call.
+        '''
+        if _consume_quota(obj_name):
+            return True
+        if obj_name not in self.exhausted:
+            self.exhausted.add(obj_name)
+            logger.info('skipped %s tasks: quota reached', obj_name)
+
+    def _search_hash(self, obj, obj_name, queue, file_, lang):
+        start = time.time()
+        try:
+            hash, size = get_hash(file_.file)
+            if not hash or not self._consume(obj_name):
+                return
+            for url in obj.results_by_hash(hash, size, lang):
+                self.matched.add((obj_name, file_.file, lang))
+                queue.put((self._download, (obj_name, url, file_)))
+        except RateLimitReached:
+            self.exhausted.add(obj_name)
+            _block_plugin(obj_name)
+        finally:
+            self._add_stat(obj_name, 'search', start)
+
+    def _search(self, obj, obj_name, queue, query, lang, files):
+        if not self._consume(obj_name):
+            return
+        start = time.time()
+        try:
+            for url in obj.results(*(query + (lang,))):
+                for file_ in files:
+                    queue.put((self._download, (obj_name, url, file_)))
+        finally:
+            self._add_stat(obj_name, 'search', start)
+
+    def _download(self, obj, obj_name, url, file_):
+        doc = {'url': url, 'file': file_.file}
+        if Subtitles.find_one(doc):
+            return
+        if not self._consume(obj_name):
+            return
+
+        start = time.time()
+        try:
+            files_dst = obj.download(url, file_.get_subtitles_path(), self.temp_dir)
+        except RateLimitReached:
+            self.exhausted.add(obj_name)
+            _block_plugin(obj_name)
+            return
+        finally:
+            self._add_stat(obj_name, 'download', start)
+        if not files_dst:
+            return
+        for file_dst in files_dst:
+            logger.info('downloaded %s on %s', file_dst, obj_name)
+
+        doc['created'] = datetime.utcnow()
+        try:
+            Subtitles.insert(doc, safe=True)
+        except DuplicateKeyError:
+            pass
+
+    def _worker(self, obj, obj_name, queue):
+        while True:
+            task = queue.get()
+            try:
+                if task is None:
+                    return
+                if obj_name in self.exhausted:
+                    continue
+                func, args = task
+                func(obj, *args)
+            except Exception, e:
+                logger.error('failed to process %s subtitles task: %s', obj_name, str(e))
+            finally:
+                queue.task_done()
+
+    def _start_workers(self, obj, obj_name):
+        queue = Queue()
+        concurrency = PLUGINS_CONCURRENCY[obj_name]
+        for i in range(concurrency):
+            if i:
+                obj = _get_plugin(obj_name)
+            thread = threading.Thread(target=self._worker,
+                    args=(obj, obj_name, queue))
+            thread.daemon = True
+            thread.start()
+        return queue, concurrency
+
+    def process(self, query, langs):
+        '''Search and download subtitles.
+
+        :param query: tuple (name, season, episode, date)
+        :return: True if at least one plugin was accessible
+        '''
+        plugins = []
+        for obj_name in get_available_plugins():
+            obj = _get_plugin(obj_name)
+            if not obj.accessible:
+                continue
+            queue, concurrency = self._start_workers(obj, obj_name)
+            langs_ = [LANGS_DEF[obj_name][l] for l in langs
+                    if LANGS_DEF[obj_name].get(l)]
+            plugins.append((obj_name, queue, concurrency, langs_,
+                    getattr(obj, 'by_hash', False)))
+
+        for obj_name, queue, concurrency, langs_, by_hash in plugins:
+            for lang in langs_:
+                if by_hash:
+                    for file_ in self.files:
+                        queue.put((self._search_hash,
+                                (obj_name, queue, file_, lang)))
+                else:
+                    queue.put((self._search,
+                            (obj_name, queue, query, lang, self.files)))
+
+        # Fall back to name queries for the files without hash results
+        for obj_name, queue, concurrency, langs_, by_hash in plugins:
+            if not by_hash:
+                continue
+            queue.join()
+            for lang in langs_:
+                files = [f for f in self.files
+                        if (obj_name, f.file, lang) not in self.matched]
+                if files:
+                    queue.put((self._search,
+                            (obj_name, queue, query, lang, files)))
+
+        for obj_name, queue, concurrency, langs_, by_hash in plugins:
+            queue.join()
+            for i in range(concurrency):
+                queue.put(None)
+
+        for obj_name, stat in self.stats.items():
+            logger.info('processed %s subtitles in %.02f seconds (search: %.02f, downloads: %d in %.02f)',
+                    obj_name, stat['search'] + stat['download'],
+                    stat['search'], stat['nb_downloads'], stat['download'])
+        return bool(plugins)
+
+
 @timer(300)
 def search_subtitles(media_id):
     media = Media.get(media_id)
@@ -80,7 +271,7 @@ def search_subtitles(media_id):
         logger.error('missing subtitles search langs')
         return
 
-    root_path = Settings.get_settings('paths')['media']['video'].rstrip('/') + '/'
+    root_path = get_root_path()
 
     info = media['info']
     if info['subtype'] == 'tv':
@@ -94,90 +285,115 @@ def search_subtitles(media_id):
         episode = None
         date = media.get('extra', {}).get('imdb', {}).get('date')
 
-    subtitles_langs = []
-    plugins = {
-        'subscene': Subscene(),
-        'opensubtitles': Opensubtitles(**Settings.get_settings('opensubtitles')),
-        }
-
-    stat = []
-    for file in media['files']:
-        if not validate_file(file, root_path):
-            continue
-
-        file_ = get_file(file)
-        dst = file_.get_subtitles_path()
-
-        processed = False
-        for lang in search_langs:
-            logger.debug('searching %s subtitles for "%s" (%s)', lang, media['name'], file)
-
-            for obj_name, obj in plugins.items():
-                if not obj.accessible:
-                    continue
-                processed = True
-                lang_ = LANGS_DEF[obj_name].get(lang)
-                if not lang_:
-                    continue
-
-                for url in obj.results(name, season, episode, date, lang_):
-                    doc = {'url': url, 'file': file_.file}
-                    if Subtitles.find_one(doc):
-                        continue
-                    try:
-                        files_dst = obj.download(url, dst, temp_dir)
-                    except RateLimitReached:
-                        break
-                    if not files_dst:
-                        continue
-                    for file_dst in files_dst:
-                        logger.info('downloaded %s on %s', file_dst, obj_name)
-
-                    doc['created'] = datetime.utcnow()
-                    Subtitles.insert(doc, safe=True)
+    files = [get_file(f) for f in media['files'] if validate_file(f, root_path)]
+    processed = True
+    if files:
+        logger.debug('searching %s subtitles for "%s" (%s)', search_langs, media['name'], [f.file for f in files])
+        processed = SubtitlesSearch(files, temp_dir).process(
+                (name, season, episode, date), search_langs)
 
+    subtitles_langs = []
+    for file_ in files:
         for lang in search_langs:
             if file_.set_subtitles(lang):
                 subtitles_langs.append(lang)
 
-        stat.append(processed)
-
-    if False not in stat:
+    if processed:
         media['updated_subs'] = datetime.utcnow()
     media['subtitles'] = sorted(list(set(subtitles_langs)))
+    media.update(get_subs_info(media, root_path))
     Media.save(media, safe=True)
+    Version.bump('media')
 
 def process_media():
-    count = 0
+    target = '%s.workers.subtitles.search_subtitles' % settings.PACKAGE_NAME
+    count = get_free_slots(target, WORKERS_LIMIT)
+    if not count:
+        return
+    if not get_available_plugins():
+        logger.debug('skipped subtitles search: all plugins reached their quota')
+        return
 
-    root_path = Settings.get_settings('paths')['media']['video'].rstrip('/') + '/'
     for media in Media.find({
-            'type': 'video',
-            'files': {'$exists': True},
-            '$or': [
-                {'updated_subs': {'$exists': False}},
-                {'updated_subs': {'$lt': datetime.utcnow() - DELTA_UPDATE_DEF[-1][1]}},
-                ],
+            'has_video_under_root': True,
+            'next_subs_check': {'$lt': datetime.utcnow()},
             },
-            sort=[('updated_subs', ASCENDING)]):
-        if not [f for f in media['files'] if f.startswith(root_path)]:
-            continue
-        if not validate_media(media):
-            continue
-
-        target = '%s.workers.subtitles.search_subtitles' % settings.PACKAGE_NAME
-        get_factory().add(target=target,
-                args=(media['_id'],), timeout=TIMEOUT_SEARCH)
-
-        count += 1
-        if count == WORKERS_LIMIT:
-            return
+            fields=['_id'],
+            sort=[('next_subs_check', ASCENDING)]):
+        if add_job(target, args=(media['_id'],), timeout=TIMEOUT_SEARCH):
+            count -= 1
+            if not count:
+                return
+
+def clean_subtitles():
+    '''Remove the subtitles records of missing files, checking
+    CLEAN_LIMIT records at most from the last checked one.
+
+    Records of files removed from the media are already removed
+    by the file worker.
+    '''
+    res = Work.get_info(NAME, 'cleaned')
+    if res and res > datetime.utcnow() - DELTA_CLEAN:
+        return
+
+    spec = {}
+    cursor = Work.get_info(NAME, 'clean_cursor')
+    if cursor:
+        spec['_id'] = {'$gt': cursor}
+    ids = []
+    last_id = None
+    for res in Subtitles.find(spec, fields=['file'],
+            sort=[('_id', ASCENDING)], limit=CLEAN_LIMIT):
+        if not os.path.exists(res['file']):
+            ids.append(res['_id'])
+        last_id = res['_id']
+
+    if ids:
+        Subtitles.remove({'_id': {'$in': ids}}, safe=True)
+        logger.info('removed %d obsolete subtitles records', len(ids))
+    Work.set_info(NAME, 'clean_cursor', last_id)
+    Work.set_info(NAME, 'cleaned', datetime.utcnow())
+
+def remove_duplicates():
+    '''Remove the duplicate subtitles records, stored
+    before the records were unique by file and url.
+    '''
+    ids = []
+    seen = set()
+    for res in Subtitles.find({}, fields=['file', 'url']):
+        key = res['file'], res['url']
+        if key in seen:
+            ids.append(res['_id'])
+        else:
+            seen.add(key)
+    if ids:
+        Subtitles.remove({'_id': {'$in': ids}}, safe=True)
+        logger.info('removed %d duplicate subtitles records', len(ids))
+
+def create_indexes():
+    '''Create the indexes once, after removing the duplicates
+    preventing the unique index creation.
+    '''
+    if Work.get_info(NAME, 'indexed'):
+        return
+    try:
+        remove_duplicates()
+        Subtitles.ensure_index([('file', ASCENDING), ('url', ASCENDING)],
+                unique=True)
+        Media.ensure_index([
+                ('has_video_under_root', ASCENDING),
+                ('next_subs_check', ASCENDING),
+                ])
+    except OperationFailure, e:
+        logger.error('failed to create subtitles indexes: %s', str(e))
+        return
+    Work.set_info(NAME, 'indexed', datetime.utcnow())
 
 @loop(minutes=2)
 def run():
+    create_indexes()
+
     if Google().accessible:
         process_media()
 
-    for res in Subtitles.find():
-        if not os.path.exists(res['file']):
-            Subtitles.remove({'_id': res['_id']}, safe=True)
+    clean_subtitles()
@@ -1,9 +1,8 @@
 import os.path
-import re
 from datetime import datetime, timedelta
 import logging
 
-from pymongo import DESCENDING
+from pymongo import ASCENDING, DESCENDING
 
 from mist import get_user, get_host
 
@@ -16,43 +15,53 @@ from filetools.media import iter_files, get_size
 from mediacore.model.sync import Sync
 from mediacore.model.media import Media
 from mediacore.model.settings import Settings
+from mediacore.model.work import Work
 
-from media import settings, get_factory
+from media import settings
+from media.dispatch import add_job, get_free_slots
+from media.model.dirsize import DirSize
+from media.model.manifest import Manifest
+from media.model.host import HostState
+from media.model.version import Version
+from media.utils.genres import normalize_genre
+from media.utils.manifest import plan_sync
 
 
-WORKERS_LIMIT = 4
+NAME = os.path.splitext(os.path.basename(__file__))[0]
+WORKERS_LIMIT = 4     # hosts processed in parallel
+SYNCS_PER_JOB_MAX = 5
 TIMEOUT_SYNC = 600     # seconds
+DELTA_MANIFEST = timedelta(hours=6)
+TRANSFER_SUCCESS = 'successful'     # status of the transfer package
+DELTA_CHECK_STATUS = timedelta(days=1)
 
 logger = logging.getLogger(__name__)
 
 
-def _validate_genres(extra, category, re_incl, re_excl):
-    def get_genres(key):
-        res = extra.get(key, {}).get('genre') or []
-        if not isinstance(res, (list, tuple)):
-            res = [res]
-        return res
-
-    if re_incl or re_excl:
-        if category == 'movies':
-            genres = get_genres('imdb')
-        elif category == 'tv':
-            genres = get_genres('tvrage')
-        elif category == 'music':
-            genres = get_genres('sputnikmusic') + get_genres('lastfm')
-        else:
-            genres = []
-
-        genres = ' '.join(genres)
-        if re_incl and not re_incl.search(genres):
-            return False
-        if re_excl and re_excl.search(genres):
-            return False
-
-    return True
+def get_dir_size(dir):
+    '''Get the directory size in MB, from the cache
+    if the directory modification time has not changed.
+    '''
+    try:
+        mtime = os.stat(dir).st_mtime
+    except OSError:
+        return 0
+    res = DirSize.find_one({'_id': dir})
+    if res and res['mtime'] == mtime:
+        return res['size']
 
-def _get_genre_re(genre):
-    return re.compile(r'\b(%s)\b' % '|'.join(genre), re.I)
+    size = 0
+    for file in iter_files(dir):
+        size_ = get_size(file)
+        if size_:
+            size += size_ / 1024
+    DirSize.save({
+            '_id': dir,
+            'mtime': mtime,
+            'size': size,
+            'updated': datetime.utcnow(),
+            }, safe=True)
+    return size
 
 @timer()
 def get_recent_media(category, genre_incl=None, genre_excl=None,
@@ -60,31 +69,30 @@ def get_recent_media(category, genre_incl=None, genre_excl=None,
     dirs = []
     size = 0
 
-    if genre_incl:
-        genre_incl = _get_genre_re(genre_incl)
-    if genre_excl:
-        genre_excl = _get_genre_re(genre_excl)
-
     spec = {
         'info.subtype': category,
         'extra': {'$exists': True},
         'date': {'$exists': True},
         }
-    for media in Media.find(spec, sort=[('date', DESCENDING)]):
-        if not _validate_genres(media['extra'], category,
-                genre_incl, genre_excl):
-            continue
-
+    if genre_incl:
+        spec.setdefault('genres', {})['$in'] = [normalize_genre(g) for g in genre_incl]
+    if genre_excl:
+        spec.setdefault('genres', {})['$nin'] = [normalize_genre(g) for g in genre_excl]
+
+    Media.ensure_index([
+            ('info.subtype', ASCENDING),
+            ('genres', ASCENDING),
+            ('date', DESCENDING),
+            ])
+    for media in Media.find(spec, fields=['_id'],
+            sort=[('date', DESCENDING)]):
         dirs_ = Media.get_bases(media['_id'], dirs_only=True)
         dirs_ = [d for d in dirs_ if d not in dirs]
         if not dirs_:
             continue
 
-        for dir in dirs_:
-            for file in iter_files(dir):
-                size_ = get_size(file)
-                if size_:
-                    size += size_ / 1024
+        if size_max:
+            size += sum([get_dir_size(d) for d in dirs_])
         if size_max and size >= size_max:
             break
 
@@ -95,38 +103,153 @@ def get_recent_media(category, genre_incl=None, genre_excl=None,
 
     return dirs
 
+def _get_manifest_id(host, path):
+    return '%s@%s:%s' % (host.username, host.host, path)
+
+def get_manifest(host, path):
+    '''Get the remote directory entries from the cached manifest,
+    listing the directory only if the manifest is stale.
+
+    :return: dict {name: size of the transferred directory,
+        None if unknown}
+    '''
+    res = Manifest.find_one({'_id': _get_manifest_id(host, path)})
+    if res and not res['stale'] \
+            and res['updated'] > datetime.utcnow() - DELTA_MANIFEST:
+        return dict([(e['name'], e['size']) for e in res['entries']])
+
+    sizes = dict([(e['name'], e['size']) for e in res['entries']]) if res else {}
+    entries = {}
+    for dir_ in host.listdir(path):
+        name = os.path.basename(dir_)
+        entries[name] = sizes.get(name)
+    set_manifest(host, path, entries)
+    return entries
+
+def set_manifest(host, path, entries, stale=False):
+    '''Save the remote directory entries.
+
+    :param stale: True to list the directory on the next run
+        (e.g.: after queuing a transfer)
+    '''
+    Manifest.save({
+            '_id': _get_manifest_id(host, path),
+            'entries': [{'name': k, 'size': v} for k, v in entries.items()],
+            'stale': stale,
+            'updated': datetime.utcnow(),
+            }, safe=True)
+
+def check_transfer_status():
+    '''Check the finished transfers have the expected success status,
+    the directories of the syncs being transferred again otherwise.
+    '''
+    res = Work.get_info(NAME, 'status_checked')
+    if res and res > datetime.utcnow() - DELTA_CHECK_STATUS:
+        return
+    Work.set_info(NAME, 'status_checked', datetime.utcnow())
+    spec = {'sync_id': {'$exists': True}, 'finished': {'$ne': None}}
+    if Transfer.find_one(spec) \
+            and not Transfer.find_one(dict(spec, status=TRANSFER_SUCCESS)):
+        logger.error('no finished sync transfer with status "%s": transferred sizes are not recorded', TRANSFER_SUCCESS)
+
+def get_transferred(sync):
+    '''Get the sizes of the directories of the last transfer
+    of the sync if it finished successfully.
+
+    :return: dict {name: size}
+    '''
+    if not sync.get('transfer_id') or not sync.get('pending'):
+        return {}
+    transfer = Transfer.find_one({'_id': sync['transfer_id']})
+    if not transfer or not transfer.get('finished') \
+            or transfer.get('status') != TRANSFER_SUCCESS:
+        return {}
+    return dict(sync['pending'])
+
 def set_retry(sync, error=''):
     delta = Settings.get_settings('sync')['retry_delta']
     sync['reserved'] = datetime.utcnow() + timedelta(minutes=delta)
     if error:
         sync['error'] = error
     Sync.save(sync, safe=True)
+    Version.bump('sync')
 
-@timer()
-def process_sync(sync_id):
-    sync = Sync.get(sync_id)
-    if not sync:
-        return
-    if Transfer.find_one({'sync_id': sync['_id'], 'finished': None}):
-        set_retry(sync, 'transfer already queued')
-        return
-    user = get_user(sync['user'])
-    if not user:
-        Sync.remove({'_id': sync['_id']}, safe=True)
-        logger.info('failed to find user %s', sync['user'])
-        return
+def _get_due_spec():
+    return {'$or': [
+            {'reserved': None},
+            {'reserved': {'$lt': datetime.utcnow()}},
+            ]}
+
+def set_host_down(user_id):
+    delta = Settings.get_settings('sync')['retry_delta']
+    HostState.update({'_id': user_id},
+            {'$set': {'down': datetime.utcnow() + timedelta(minutes=delta)}},
+            upsert=True, safe=True)
+
+def get_down_users():
+    return [r['_id'] for r in HostState.find(
+            {'down': {'$gt': datetime.utcnow()}}, fields=['_id'])]
+
+def close_host(host):
+    close = getattr(host, 'close', None)
+    if close:
+        try:
+            close()
+        except Exception, e:
+            logger.debug('failed to close connection to %s: %s', host.host, str(e))
+
+def process_sync(sync, user, host):
     path_root = sync['parameters'].get('path') or user.get('paths', {}).get(sync['category'])
     if not path_root:
         Sync.remove({'_id': sync['_id']}, safe=True)
+        Version.bump('sync')
         logger.info('failed to find %s path for user %s', sync['category'], sync['user'])
         return
     dst_path = os.path.join(path_root, sync['dst'].strip('/')).rstrip('/') + '/'
+    _process_sync(sync, host, path_root, dst_path)
 
-    host = get_host(user=sync['user'])
-    if not host:
-        set_retry(sync, 'user %s is down' % sync['user'])
+@timer()
+def process_syncs(user_id):
+    '''Process the due syncs of a user using a single host connection.
+
+    Connections are not pooled across jobs since each job runs in its
+    own process, and the transfers connect to the host themselves.
+    '''
+    syncs = []
+    for sync in Sync.find(dict(_get_due_spec(), user=user_id),
+            sort=[('parameters.id', DESCENDING)],
+            limit=SYNCS_PER_JOB_MAX):
+        if Transfer.find_one({'sync_id': sync['_id'], 'finished': None}):
+            set_retry(sync, 'transfer already queued')
+        else:
+            syncs.append(sync)
+    if not syncs:
         return
 
+    user = get_user(user_id)
+    if not user:
+        Sync.remove({'user': user_id}, safe=True)
+        Version.bump('sync')
+        logger.info('failed to find user %s', user_id)
+        return
+
+    host = get_host(user=user_id)
+    if not host:
+        set_host_down(user_id)
+        for sync in syncs:
+            set_retry(sync, 'user %s is down' % user_id)
+        return
+    try:
+        for sync in syncs:
+            try:
+                process_sync(sync, user, host)
+            except Exception, e:
+                logger.error('failed to process sync %s: %s', sync['_id'], str(e))
+                set_retry(sync, str(e))
+    finally:
+        close_host(host)
+
+def _process_sync(sync, host, path_root, dst_path):
     media_id = sync['parameters'].get('id')
     if media_id:
         src = Media.get_bases(media_id, dirs_only=True)
@@ -141,44 +264,70 @@ def process_sync(sync_id):
 
     else:
         src = get_recent_media(sync['category'], **sync['parameters'])
-        src_dirs = dict([(os.path.basename(s), s) for s in src])
-
-        # Check duplicates at user path
-        for dir_ in host.listdir(path_root):
-            src_dir = src_dirs.pop(os.path.basename(dir_), None)
-            if src_dir:
-                src.remove(src_dir)
+        root_names = get_manifest(host, path_root).keys()
+        dst_entries = get_manifest(host, dst_path)
+        for name, size in get_transferred(sync).items():
+            if name in dst_entries:
+                dst_entries[name] = size
+        to_transfer, to_remove = plan_sync(src, root_names, dst_entries,
+                get_dir_size)
 
         # Delete obsolete destination files
-        for dir_ in host.listdir(dst_path):
-            if os.path.basename(dir_) not in src_dirs:
-                try:
-                    host.remove(dir_)
-                    logger.info('removed obsolete %s@%s:%s', host.username, host.host, dir_)
-                except Exception, e:
-                    logger.error('failed to remove obsolete %s@%s:%s: %s', host.username, host.host, dir_, str(e))
-
-        dst = 'sftp://%s:%s@%s%s:%s' % (host.username, host.password,
-                host.host, dst_path, host.port)
-        transfer_id = Transfer.add(src, dst, sync_id=sync['_id'])
-        logger.info('added transfer %s to %s', src, dst)
-
-        sync['transfer_id'] = transfer_id
-        sync['media'] = src
+        for name in to_remove:
+            dir_ = os.path.join(dst_path, name)
+            try:
+                host.remove(dir_)
+                dst_entries.pop(name)
+                logger.info('removed obsolete %s@%s:%s', host.username, host.host, dir_)
+            except Exception, e:
+                logger.error('failed to remove obsolete %s@%s:%s: %s', host.username, host.host, dir_, str(e))
+
+        if to_transfer:
+            src_ = [d for d, s in to_transfer]
+            dst = 'sftp://%s:%s@%s%s:%s' % (host.username, host.password,
+                    host.host, dst_path, host.port)
+            sync['transfer_id'] = Transfer.add(src_, dst, sync_id=sync['_id'])
+            logger.info('added transfer %s to %s', src_, dst)
+            # Sizes are recorded once the transfer has succeeded
+            for dir_, size in to_transfer:
+                dst_entries[os.path.basename(dir_)] = None
+        sync['pending'] = [[os.path.basename(d), s] for d, s in to_transfer]
+        set_manifest(host, dst_path, dst_entries,
+                stale=bool(to_transfer or to_remove))
+
+        sync['media'] = [s for s in src if os.path.basename(s) not in root_names]
         sync['processed'] = datetime.utcnow()
         recurrence = Settings.get_settings('sync')['recurrence']
         sync['reserved'] = datetime.utcnow() + timedelta(minutes=recurrence)
         sync['error'] = ''
         Sync.save(sync, safe=True)
 
+    Version.bump('sync')
+
 @loop(60)
 def run():
-    for sync in Sync.find({'$or': [
-            {'reserved': None},
-            {'reserved': {'$lt': datetime.utcnow()}},
-            ]},
-            sort=[('parameters.id', DESCENDING)],
-            limit=WORKERS_LIMIT):
-        target = '%s.workers.sync.process_sync' % settings.PACKAGE_NAME
-        get_factory().add(target=target,
-                args=(sync['_id'],), timeout=TIMEOUT_SYNC)
+    check_transfer_status()
+
+    target = '%s.workers.sync.process_syncs' % settings.PACKAGE_NAME
+    count = get_free_slots(target, WORKERS_LIMIT)
+    if not count:
+        return
+
+    users = {}
+    for sync in Sync.find(_get_due_spec(), fields=['user']):
+        users[sync['user']] = users.get(sync['user'], 0) + 1
+
+    HostState.update({'_id': {'$nin': users.keys()}, 'queued': {'$gt': 0}},
+            {'$set': {'queued': 0}}, multi=True, safe=True)
+    down = get_down_users()
+    for user, nb in users.items():
+        HostState.update({'_id': user},
+                {'$set': {'queued': nb}}, upsert=True, safe=True)
+        if user in down:
+            logger.debug('skipped %d syncs for user %s: host is down', nb, user)
+            continue
+        timeout = TIMEOUT_SYNC * min(nb, SYNCS_PER_JOB_MAX)
+        if add_job(target, args=(user,), timeout=timeout):
+            count -= 1
+            if not count:
+                break
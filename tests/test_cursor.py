@@ -0,0 +1,89 @@
+import unittest
+from datetime import datetime
+
+from pymongo import ASCENDING, DESCENDING
+
+from media.utils.cursor import get_cursor, get_cursor_spec
+
+
+SORT = [('rating', DESCENDING), ('name', ASCENDING), ('_id', DESCENDING)]
+OBJS = [
+    {'_id': 1, 'rating': 8, 'name': 'b'},
+    {'_id': 2, 'rating': 8, 'name': None},
+    {'_id': 3, 'rating': None, 'name': 'a'},
+    {'_id': 4, 'rating': 5, 'name': 'a'},
+    {'_id': 5, 'rating': 8, 'name': 'b'},
+    {'_id': 6, 'rating': None, 'name': None},
+    {'_id': 7, 'rating': 5},
+    ]
+
+
+def _cmp_values(a, b):
+    # Null values are sorted first
+    if a is None or b is None:
+        return cmp(a is not None, b is not None)
+    return cmp(a, b)
+
+def _sort(objs, sort):
+    def _cmp(a, b):
+        for key, direction in sort:
+            res = _cmp_values(a.get(key), b.get(key))
+            if res:
+                return res if direction == ASCENDING else -res
+        return 0
+    return sorted(objs, cmp=_cmp)
+
+def _match_value(value, cond):
+    if not isinstance(cond, dict):
+        return value == cond
+    for op, arg in cond.items():
+        if op == '$ne':
+            if value == arg:
+                return False
+        elif value is None:
+            return False
+        elif op == '$gt' and not value > arg:
+            return False
+        elif op == '$lt' and not value < arg:
+            return False
+    return True
+
+def _match(obj, spec):
+    if '$or' in spec:
+        return any(_match(obj, s) for s in spec['$or'])
+    return all(_match_value(obj.get(k), c) for k, c in spec.items())
+
+
+class CursorTest(unittest.TestCase):
+
+    def test_following_objects(self):
+        objs = _sort(OBJS, SORT)
+        for i, obj in enumerate(objs):
+            cursor = get_cursor(obj, 'rating', SORT)
+            spec = get_cursor_spec(cursor, 'rating', SORT)
+            res = [o for o in objs if _match(o, spec)]
+            self.assertEqual(res, objs[i + 1:])
+
+    def test_dates(self):
+        sort = [('date', DESCENDING), ('_id', DESCENDING)]
+        objs = _sort([
+                {'_id': 1, 'date': datetime(2014, 1, 1)},
+                {'_id': 2, 'date': datetime(2014, 1, 2)},
+                {'_id': 3, 'date': None},
+                ], sort)
+        cursor = get_cursor(objs[0], 'date', sort)
+        spec = get_cursor_spec(cursor, 'date', sort)
+        self.assertEqual([o for o in objs if _match(o, spec)], objs[1:])
+
+    def test_sort_mismatch(self):
+        cursor = get_cursor(OBJS[0], 'rating', SORT)
+        self.assertRaises(ValueError, get_cursor_spec, cursor, 'name', SORT)
+
+    def test_length_mismatch(self):
+        cursor = get_cursor(OBJS[0], 'rating', SORT)
+        self.assertRaises(ValueError, get_cursor_spec, cursor, 'rating',
+                SORT[:2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+
+from media.utils.manifest import plan_sync
+
+
+SIZES = {
+    '/media/a': 100,
+    '/media/b': 200,
+    '/media/c': 300,
+    }
+
+
+class PlanSyncTest(unittest.TestCase):
+
+    def _plan(self, src, root_names, dst_entries):
+        return plan_sync(src, root_names, dst_entries, SIZES.get)
+
+    def test_new_directories(self):
+        to_transfer, to_remove = self._plan(['/media/a', '/media/b'], [], {})
+        self.assertEqual(sorted(to_transfer),
+                [('/media/a', 100), ('/media/b', 200)])
+        self.assertEqual(to_remove, [])
+
+    def test_transferred_directories(self):
+        to_transfer, to_remove = self._plan(['/media/a', '/media/b'], [],
+                {'a': 100, 'b': 200})
+        self.assertEqual(to_transfer, [])
+        self.assertEqual(to_remove, [])
+
+    def test_size_changed(self):
+        to_transfer, to_remove = self._plan(['/media/a'], [], {'a': 50})
+        self.assertEqual(to_transfer, [('/media/a', 100)])
+
+    def test_unknown_size(self):
+        to_transfer, to_remove = self._plan(['/media/a'], [], {'a': None})
+        self.assertEqual(to_transfer, [('/media/a', 100)])
+        self.assertEqual(to_remove, [])
+
+    def test_root_directories(self):
+        to_transfer, to_remove = self._plan(['/media/a', '/media/c'], ['c'],
+                {'c': 300})
+        self.assertEqual(to_transfer, [('/media/a', 100)])
+        self.assertEqual(to_remove, ['c'])
+
+    def test_obsolete_directories(self):
+        to_transfer, to_remove = self._plan(['/media/a'], [],
+                {'a': 100, 'old': 10})
+        self.assertEqual(to_transfer, [])
+        self.assertEqual(to_remove, ['old'])
+
+
+if __name__ == '__main__':
+    unittest.main()